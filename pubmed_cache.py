@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import logging as log
+
+TTL = 7 * 24 * 3600
+MAX_SIZE = 2 * 1024 * 1024 * 1024
+# Evict down to this ratio of MAX_SIZE, so that eviction is not run on every put
+EVICT_TO = 0.9
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    final_url TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+'''
+
+
+class ResponseCache:
+    """
+    On-disk cache of HTTP responses keyed by URL, stored in SQLite
+
+    Bodies are compressed with zlib. A response younger than `ttl` is used
+    without touching the network, an older one is revalidated with its ETag or
+    Last-Modified. The least recently used responses are evicted when the
+    cache grows beyond `max_size` bytes.
+    """
+
+    def __init__(self, path, ttl=TTL, max_size=MAX_SIZE, readonly=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.readonly = readonly
+        if readonly:
+            # Readers in other processes, which do not keep track of access
+            from urllib.request import pathname2url
+            uri = 'file:' + pathname2url(os.path.abspath(path)) + '?mode=ro'
+            self.conn = sqlite3.connect(uri, uri=True)
+        else:
+            self.conn = sqlite3.connect(path)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(SCHEMA)
+        self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, url):
+        """
+        Get cached response of url as a dict, None if not cached
+        """
+        row = self.conn.execute(
+            'SELECT final_url, status, headers, body, etag, last_modified, fetched_at '
+            'FROM responses WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        final_url, status, headers, body, etag, last_modified, fetched_at = row
+        try:
+            content = zlib.decompress(body)
+        except zlib.error:
+            log.debug("Corrupted cache entry of %s, ignored", url)
+            return None
+        if not self.readonly:
+            self.conn.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time.time(), url))
+            self.conn.commit()
+        return {
+            'url': final_url,
+            'status_code': status,
+            'headers': json.loads(headers),
+            'content': content,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fresh': time.time() - fetched_at < self.ttl
+        }
+
+    def put(self, url, final_url, status, headers, content):
+        body = zlib.compress(content)
+        now = time.time()
+        old = self.conn.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+        self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+            url, final_url, status, json.dumps(headers), body, len(body),
+            headers_get(headers, 'ETag'), headers_get(headers, 'Last-Modified'), now, now))
+        self.conn.commit()
+        self.size += len(body) - (old[0] if old else 0)
+        if self.size > self.max_size:
+            self.evict()
+
+    def touch(self, url):
+        """
+        Mark the response of url as fresh again, after revalidated
+        """
+        now = time.time()
+        self.conn.execute('UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE url = ?',
+                          (now, now, url))
+        self.conn.commit()
+
+    def evict(self):
+        target = self.max_size * EVICT_TO
+        evicted = 0
+        while self.size > target:
+            rows = self.conn.execute(
+                'SELECT url, size FROM responses ORDER BY accessed_at LIMIT 1000').fetchall()
+            if not rows:
+                break
+            for url, size in rows:
+                if self.size <= target:
+                    break
+                self.conn.execute('DELETE FROM responses WHERE url = ?', (url,))
+                self.size -= size
+                evicted += 1
+        self.conn.commit()
+        log.debug("Evict %d responses from cache %s", evicted, self.path)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def headers_get(headers, name):
+    """
+    Get header from a list of (name, value) pairs, case-insensitively
+    """
+    for key, value in headers:
+        if key.lower() == name.lower():
+            return value
+    return None
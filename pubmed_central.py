@@ -1,150 +1,65 @@
 import os
-import sys
 import json
-import requests
+import asyncio
 import logging as log
 import traceback
-from typing import List, Tuple
+from typing import List, Dict, Iterator
 import argparse as arg
-from lxml import etree
-from fake_useragent import UserAgent
+import pubmed_fetch as fetch
+import pubmed_journal as journal
+import pubmed_idconv as idconv
+import pubmed_source as sources
 
 PDF_BASE = 'https://www.ncbi.nlm.nih.gov/'
 USE_PROXY = False
 OUTPUT_DIR = 'pmc_pdfs/'
-PROXY_POOL_BASE = 'http://118.24.52.95'
 PMID_SOURCE = ''
-PUBMED_ID_TYPE = ''
 LOCKFILE = 'pubmed_central.lock'
 FAILEDFILE = 'failed.json'
-REQUESTS_PARAM = {
-    'timeout': 30
-}
+JOURNAL = None
+WORKERS = 1
+# Resolve PMIDs to PMCIDs in batches before downloading, None if disabled
+IDCONV_CACHE = 'idconv.jsonl'
+IDCONV = None
 
 log.basicConfig(level=log.INFO,
                 format='%(asctime)s:%(lineno)d - %(levelname)s: %(message)s')
 
-ua = UserAgent()
-USER_AGENT = ua.random
 
-
-def get_proxy():
-    return requests.get(f"{PROXY_POOL_BASE}/get/").json()
+async def download_to(url, pmid):
+    # Filename
+    filename = f'{OUTPUT_DIR}{pmid}.pdf'
+    return await fetch.download_to(url, filename, use_proxy=USE_PROXY)
 
 
-def delete_proxy(proxy):
-    requests.get('{}/get/delete/?proxy={}'.format(PROXY_POOL_BASE, proxy))
+def get_id_type(pmid):
+    return 'pmcid' if pmid.startswith('PMC') else 'pmid'
 
 
-def get_html(url, use_proxy=USE_PROXY):
-    """
-    Get html from url
-    """
-    retry_count = 5
-    # Proxy config
-    if use_proxy:
-        proxy = get_proxy().get('proxy')
-        proxies = {'http': 'http://{}'.format(proxy)}
-    else:
-        proxies = None
-    # Headers
-    headers = {
-        'User-Agent': USER_AGENT
-    }
-    # Start
-    while retry_count > 0:
-        try:
-            html = requests.get(url, proxies=proxies, headers=headers, **REQUESTS_PARAM)
-            return html
-        except Exception:
-            retry_count -= 1
-    # Delete proxy
-    if use_proxy:
-        delete_proxy(proxy)
-    log.warning("Fail to get url: %s, maximum retries count exceed.", url)
-    return ''
-
-
-def download(file_path, url, headers=None, proxies=None):
-    # Check file size
-    r1 = requests.get(url, stream=True, headers=headers, proxies=proxies, **REQUESTS_PARAM)
-    total_size = int(r1.headers['Content-Length'])
-    if os.path.exists(file_path):
-        temp_size = os.path.getsize(file_path)  # already downloaded
-    else:
-        temp_size = 0
-    if temp_size >= total_size:
-        return
-    # Continue download
-    headers['Range'] = 'bytes=%d-' % temp_size
-    r = requests.get(url, stream=True, headers=headers, proxies=proxies, **REQUESTS_PARAM)
-    with open(file_path, 'ab') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                temp_size += len(chunk)
-                f.write(chunk)
-                f.flush()
-                done = int(50 * temp_size / total_size)
-                sys.stdout.write('\r[%s%s] %.2f%%' % (
-                    '=' * done, ' ' * (50 - done), 100 * temp_size / total_size))
-                sys.stdout.flush()
-    print()
-
-
-def download_to(url, pmid, use_proxy=USE_PROXY):
-    # Filename
-    filename = f'{OUTPUT_DIR}{pmid}.pdf'
-    # Proxy config
-    if use_proxy:
-        proxy = get_proxy().get('proxy')
-        proxies = {'http': 'http://{}'.format(proxy)}
-    else:
-        proxies = None
-    # Headers
-    headers = {
-        'User-Agent': USER_AGENT
-    }
-    # Download
-    retry_count = 5
-    err = None
-    while retry_count > 0:
-        try:
-            download(filename, url, headers=headers, proxies=proxies)
-            return True
-        except Exception as e:
-            err = e
-            retry_count -= 1
-    if use_proxy:
-        delete_proxy(proxy)
-    log.warning("Fail to download pdf: %s, maximum retries count exceed.", url)
-    log.warning("%s\n%s", err, traceback.format_exc())
-    return False
-
-
-def get_pmc_html(pmid):
-    if PUBMED_ID_TYPE == 'pmcid':
+async def get_pmc_html(pmid):
+    if get_id_type(pmid) == 'pmcid':
         url = f'https://pmc.ncbi.nlm.nih.gov/articles/{pmid}/'
     else:
         url = f'https://www.ncbi.nlm.nih.gov/pmc/articles/pmid/{pmid}/'
 
-    return get_html(url)
+    return await fetch.get_html(url, use_proxy=USE_PROXY)
 
 
-def download_pmc(pmid):
-    if pmid.startswith('PMC'):
-        PUBMED_ID_TYPE = 'pmcid'
-        url = f'https://pmc.ncbi.nlm.nih.gov/articles/{pmid}/'
-    else:
-        PUBMED_ID_TYPE = 'pmid'
-        url = f'https://www.ncbi.nlm.nih.gov/pmc/articles/pmid/{pmid}/'
+async def download_pmc(pmid, pmcid=None):
+    """
+    Download PDF of pmid, from the article page of pmcid if resolved already
+    """
+    pmid = str(pmid)
+    PUBMED_ID_TYPE = get_id_type(pmid)
 
     log.info("Start download pdf for %s %s", PUBMED_ID_TYPE, pmid)
 
-    response = get_pmc_html(pmid)
+    response = await get_pmc_html(pmcid or pmid)
     if not response:
         log.warning("Failed to retrieve data from sever for %s %s.", PUBMED_ID_TYPE, pmid)
         log.warning("This might be a temporary problem. Use argument --retry for a retry.")
         return
+    from lxml import etree
     html = etree.HTML(response.content)
     pdf_tag = html.xpath('//td[@class="format-menu"]//a[contains(@href,".pdf")]'
                          + '|//div[@class="format-menu"]//a[contains(@href,".pdf")]'
@@ -162,7 +77,7 @@ def download_pmc(pmid):
     try:
         if not os.path.exists(OUTPUT_DIR):
             os.mkdir(OUTPUT_DIR)
-        result = download_to(pdf_url, pmid)
+        result = await download_to(pdf_url, pmid)
         log.info("Successful download pdf for %s %s", PUBMED_ID_TYPE, pmid)
         return result
     except Exception as e:
@@ -184,43 +99,71 @@ def parse_arguments():
                         help='Retry the tasks in the failed file')
     parser.add_argument('--use-proxy', dest='use_proxy', action='store_true',
                         help='Use proxy pool to access Pubmed Central')
+    parser.add_argument('--no-progress', dest='no_progress', action='store_true',
+                        help='Do not show download progress')
+    fetch.add_fetch_arguments(parser)
+    parser.add_argument('--idconv-base', dest='idconv_base', action='store', default=idconv.IDCONV_BASE,
+                        help='Base URL of the PMC ID converter API')
+    parser.add_argument('--no-idconv', dest='no_idconv', action='store_true',
+                        help='Find PMC articles by their pages only, without resolving PMCIDs first')
+    parser.add_argument('-w', '--workers', dest='workers', action='store', type=int, default=1,
+                        help='Number of PDFs downloading concurrently')
     # Parse
     args = parser.parse_args()
 
     global USE_PROXY
     USE_PROXY = args.use_proxy
 
+    fetch.configure(args, parser)
+
+    idconv.IDCONV_BASE = args.idconv_base
+    if args.no_idconv:
+        global IDCONV_CACHE
+        IDCONV_CACHE = None
+
+    global WORKERS
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    WORKERS = args.workers
+    # Each worker keeps at most one connection to a host busy
+    fetch.POOL_LIMIT_PER_HOST = max(fetch.POOL_LIMIT_PER_HOST, WORKERS)
+    fetch.POOL_LIMIT = max(fetch.POOL_LIMIT, 2 * WORKERS)
+    # Progress bars of concurrent downloads would mess up the terminal
+    if args.no_progress or WORKERS > 1:
+        fetch.SHOW_PROGRESS = False
+
     if args.output_dir:
         global OUTPUT_DIR
         OUTPUT_DIR = args.output_dir
     return args
 
 
-def load_source_file() -> List[int]:
+def load_source_file() -> Iterator[int]:
     """
-    Load pmid source from a source file
+    Stream pmid source from a source file
+
+    The file is a JSON array or JSON lines of objects with `pmid`, or a text
+    file with one PMID/PMCID per line.
     """
-    # Read
+    if not os.path.isfile(PMID_SOURCE):
+        log.error("Unable to load source file %s!", PMID_SOURCE)
+        quit()
+    # Checked before the lock is created, the file is read while downloading
+    return iter_source_file()
+
+
+def iter_source_file():
     try:
-        with open(PMID_SOURCE, 'r') as f:
-            if PMID_SOURCE.lower().endswith('.json'):
-                data = json.load(f)
-            else:
-                return [line.rstrip() for line in f]
+        for item in sources.iter_file(PMID_SOURCE):
+            yield item['pmid'] if isinstance(item, dict) else item
     except Exception as e:
         log.error("Unable to load source file %s! %s", PMID_SOURCE, e)
         quit()
-    # Parse
-    try:
-        return [x['pmid'] for x in data]
-    except Exception:
-        log.error("Data source format invalid!")
-        quit()
 
 
-def load_source(args) -> List[int]:
+def load_source(args) -> Iterator[int]:
     """
-    Load pmid source
+    Load pmid source, items are read while downloading
     """
     global PMID_SOURCE
 
@@ -243,7 +186,8 @@ def load_source(args) -> List[int]:
         return load_source_file()
 
 
-def resume_from_lock(source: List[int], resume=False) -> Tuple[int, List[int]]:
+def resume_from_lock(resume=False) -> journal.Journal:
+    global JOURNAL
     # Check lock
     if os.path.exists(LOCKFILE):
         if not resume:
@@ -252,45 +196,100 @@ def resume_from_lock(source: List[int], resume=False) -> Tuple[int, List[int]]:
             quit()
         # Resume from lock
         log.info("Lock file exists, try to resume from previous work...")
-        try:
-            with open(LOCKFILE, 'r') as f:
-                lock = json.load(f)
-            if lock['source'] != PMID_SOURCE:
-                raise Exception()
-            if lock['length'] != len(source):
-                raise Exception()
-            failed = []
-            if 'failed' in lock and isinstance(lock['failed'], list):
-                failed = [int(x) for x in lock['failed']]
-            return int(lock['progress']), failed
-        except Exception:
-            log.info("Invalid lock, probably from an old task, ignored.")
+        JOURNAL = journal.Journal.resume(LOCKFILE, PMID_SOURCE)
+        if JOURNAL is not None:
+            return JOURNAL
+        log.info("Invalid lock, probably from an old task, ignored.")
     # Create lock
-    update_lock(source, 0)
+    try:
+        JOURNAL = journal.Journal.create(LOCKFILE, PMID_SOURCE)
+    except Exception as e:
+        log.error("Unable to write lock file! %s", e)
+        quit()
     log.info("Create lock file %s", LOCKFILE)
-    return 0, []
+    return JOURNAL
 
 
-def update_lock(source, progress=0, failed=[]):
-    lock = {
-        'source': PMID_SOURCE,
-        'length': len(source),
-        'progress': progress,
-        'failed': failed
-    }
+def update_lock(idx, item, state):
     try:
-        with open(LOCKFILE, 'w') as f:
-            json.dump(lock, f)
+        JOURNAL.record(idx, item, state)
     except Exception as e:
         log.error("Unable to write lock file! %s", e)
         quit()
 
 
 def clear_lock():
+    if JOURNAL is not None:
+        JOURNAL.close()
     if os.path.exists(LOCKFILE):
         os.unlink(LOCKFILE)
 
 
+async def download_worker(pmid, pmcid=None) -> bool:
+    """
+    Download one pmid as a task, treat any error as a failure
+    """
+    try:
+        return bool(await download_pmc(pmid, pmcid))
+    except Exception as e:
+        log.warning("Unexpected error in downloading %s: %s\n%s", pmid, e, traceback.format_exc())
+        return False
+
+
+async def resolve_batch(batch) -> Dict[str, str]:
+    """
+    Resolve PMCIDs of the PMIDs in a batch, None for those without PMC copy
+    """
+    if IDCONV is None:
+        return {}
+    pmids = [str(item) for _, item in batch if get_id_type(str(item)) == 'pmid']
+    return await IDCONV.resolve(pmids, use_proxy=USE_PROXY)
+
+
+async def wait_downloads(pending):
+    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        idx, item = pending.pop(task)
+        update_lock(idx, item, journal.OK if task.result() else journal.FAILED)
+
+
+async def download_all(source, workers=1) -> List[int]:
+    """
+    Download unfinished items of source with at most `workers` downloads in flight
+
+    PMCIDs of the next batch are resolved while the current batch downloads,
+    and PMIDs without PMC copy are skipped without loading their pages.
+    """
+    pending = {}
+    batches = JOURNAL.unfinished_batches(source, idconv.BATCH_SIZE)
+    batch = next(batches, None)
+    resolved = None
+    if batch is not None:
+        resolved = asyncio.ensure_future(resolve_batch(batch))
+    while batch is not None:
+        next_batch = next(batches, None)
+        next_resolved = None
+        if next_batch is not None:
+            next_resolved = asyncio.ensure_future(resolve_batch(next_batch))
+        pmcids = await resolved
+        for idx, item in batch:
+            pmid = str(item)
+            if pmid in pmcids and pmcids[pmid] is None:
+                log.info("No PMC copy for pmid %s, skipped", pmid)
+                update_lock(idx, item, journal.SKIPPED)
+                continue
+            # Keep the loop busy but the number of in-flight tasks bounded
+            while len(pending) >= workers:
+                await wait_downloads(pending)
+            update_lock(idx, item, journal.PENDING)
+            task = asyncio.ensure_future(download_worker(item, pmcids.get(pmid)))
+            pending[task] = (idx, item)
+        batch, resolved = next_batch, next_resolved
+    while pending:
+        await wait_downloads(pending)
+    return JOURNAL.failed()
+
+
 def save_failed(failed):
     data = [{'pmid': x} for x in failed]
     try:
@@ -308,18 +307,20 @@ if __name__ == "__main__":
     # Load PMID source
     source = load_source(args)
     # Start downloading
-    total = len(source)
-    start_at, failed = resume_from_lock(source, resume=args.resume)
-    for idx in range(start_at, total):
-        update_lock(source, idx, failed)
-        if download_pmc(source[idx]):
-            pass
-        else:
-            failed.append(source[idx])
+    resume_from_lock(resume=args.resume)
+    if IDCONV_CACHE:
+        IDCONV = idconv.IdConverter(IDCONV_CACHE)
+    try:
+        failed = fetch.run(download_all(source, workers=WORKERS))
+    finally:
+        if IDCONV is not None:
+            IDCONV.close()
     # Finish
+    total = JOURNAL.count
     failed_count = len(failed)
-    log.info('Completely download %d PDFs, failed %d',
-             total - failed_count, failed_count)
+    skipped_count = JOURNAL.count_state(journal.SKIPPED)
+    log.info('Completely download %d PDFs, failed %d, skipped %d without PMC copy',
+             total - failed_count - skipped_count, failed_count, skipped_count)
     if failed_count > 0:
         log.warning('Failed to fetch IDs: %s%s',
                     ', '.join(map(str, failed[:5])),
@@ -0,0 +1,239 @@
+import json
+import time
+import sqlite3
+import logging as log
+from io import BytesIO
+from typing import Dict, List
+from urllib.parse import urlencode
+import pubmed_fetch as fetch
+
+EUTILS_BASE = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+# PMIDs fetched by an EFetch request
+BATCH_SIZE = 200
+TOOL = 'PubmedToolkit'
+API_KEY = None
+# Cached articles are fetched again after this, in seconds, except offline
+ARTICLE_TTL = 7 * 24 * 3600
+
+
+def esearch_url(term, retmax=0) -> str:
+    params = {
+        'db': 'pubmed',
+        'retmode': 'json',
+        'tool': TOOL,
+        'term': term,
+        'retmax': retmax
+    }
+    if API_KEY:
+        params['api_key'] = API_KEY
+    return '{}/esearch.fcgi?{}'.format(EUTILS_BASE, urlencode(params))
+
+
+def efetch_url(pmids) -> str:
+    params = {
+        'db': 'pubmed',
+        'retmode': 'xml',
+        'tool': TOOL,
+        'id': ','.join(map(str, pmids))
+    }
+    if API_KEY:
+        params['api_key'] = API_KEY
+    return '{}/efetch.fcgi?{}'.format(EUTILS_BASE, urlencode(params, safe=','))
+
+
+def text_of(el) -> str:
+    """
+    Text of an element with its inline markup, e.g. <i> in titles
+    """
+    if el is None:
+        return None
+    return ''.join(el.itertext()).strip()
+
+
+def parse_mesh(heading) -> List[Dict]:
+    """
+    Parse a MeshHeading into records like download_mesh()
+
+    PubMed pages list a heading once per qualifier as "Descriptor / qualifier",
+    starring the major topic, and only a trailing star marks the record major.
+    """
+    descriptor = heading.find('DescriptorName')
+    if descriptor is None:
+        return []
+    name = text_of(descriptor)
+    descriptor_major = descriptor.get('MajorTopicYN') == 'Y'
+    qualifiers = heading.findall('QualifierName')
+    if not qualifiers:
+        return [{
+            'term': name,
+            'major': descriptor_major
+        }]
+    if descriptor_major:
+        name += '*'
+    return [{
+        'term': f'{name} / {text_of(qualifier)}',
+        'major': qualifier.get('MajorTopicYN') == 'Y'
+    } for qualifier in qualifiers]
+
+
+def parse_publication_date(citation) -> str:
+    """
+    Date the article entered PubMed as YYYY-MM-DD, missing parts as 1
+    """
+    date = citation.getparent().find(".//History/PubMedPubDate[@PubStatus='pubmed']")
+    if date is None or date.findtext('Year') is None:
+        return None
+    return '{:04d}-{:02d}-{:02d}'.format(int(date.findtext('Year')), int(date.findtext('Month') or 1),
+                                         int(date.findtext('Day') or 1))
+
+
+def parse_article(el) -> Dict:
+    citation = el.find('MedlineCitation')
+    if citation is None:
+        # PubmedBookArticle
+        citation = el.find('BookDocument')
+    pmid = int(citation.findtext('PMID'))
+    title = citation.find('.//ArticleTitle')
+    if title is None:
+        title = citation.find('.//BookTitle')
+    abstract = []
+    for part in citation.iterfind('.//Abstract/AbstractText'):
+        label = part.get('Label')
+        content = text_of(part)
+        abstract.append(f'{label}: {content}' if label else content)
+    meshes = []
+    for heading in citation.iterfind('MeshHeadingList/MeshHeading'):
+        meshes.extend(parse_mesh(heading))
+    keywords = [text_of(keyword) for keyword in citation.iterfind('.//Keyword')]
+    return {
+        'pmid': pmid,
+        'title': text_of(title),
+        'abstract': '\n'.join(abstract) if abstract else None,
+        'keywords': [keyword for keyword in keywords if keyword],
+        'publication_date': parse_publication_date(citation),
+        'mesh': meshes
+    }
+
+
+def iter_articles(xml):
+    """
+    Parse articles of an EFetch response one by one, freeing parsed elements
+    """
+    from lxml import etree
+    for _, el in etree.iterparse(BytesIO(xml), events=('end',),
+                                 tag=('PubmedArticle', 'PubmedBookArticle')):
+        try:
+            yield parse_article(el)
+        except Exception as e:
+            log.warning("Error in parsing article from EFetch: %s", e)
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+
+
+async def esearch(term, retmax=0, use_proxy=False) -> Dict:
+    """
+    Search PubMed by ESearch, None if the request failed
+    """
+    response = await fetch.get_html(esearch_url(term, retmax), use_proxy=use_proxy)
+    if not response or response.status_code != 200:
+        log.warning("Failed to search PubMed for %s", term)
+        return None
+    try:
+        result = json.loads(response.content)['esearchresult']
+    except Exception as e:
+        log.warning("Invalid ESearch response for %s: %s", term, e)
+        return None
+    if 'ERROR' in result:
+        log.warning("Error in searching PubMed for %s: %s", term, result['ERROR'])
+        return None
+    return result
+
+
+async def count(term, use_proxy=False) -> int:
+    """
+    Count results of a search, None if failed
+    """
+    result = await esearch(term, use_proxy=use_proxy)
+    return int(result['count']) if result is not None else None
+
+
+async def search_ids(term, retmax, use_proxy=False) -> List[int]:
+    """
+    PMIDs of the first retmax results of a search, None if failed
+    """
+    result = await esearch(term, retmax, use_proxy=use_proxy)
+    return [int(pmid) for pmid in result['idlist']] if result is not None else None
+
+
+async def fetch_articles(pmids, use_proxy=False) -> Dict[int, Dict]:
+    """
+    Fetch metadata of PMIDs by one EFetch request, keyed by PMID
+
+    PMIDs missing from the result are not returned, None if the request failed.
+    """
+    response = await fetch.get_html(efetch_url(pmids), use_proxy=use_proxy)
+    if not response or response.status_code != 200:
+        log.warning("Failed to fetch metadata of %d PMIDs from E-utilities.", len(pmids))
+        return None
+    try:
+        return {article['pmid']: article for article in iter_articles(response.content)}
+    except SyntaxError as e:  # XMLSyntaxError of lxml
+        log.warning("Invalid EFetch response for %d PMIDs: %s", len(pmids), e)
+        return None
+
+
+ARTICLE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS articles (
+    pmid INTEGER PRIMARY KEY,
+    record TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+'''
+
+
+class ArticleCache:
+    """
+    Articles parsed from EFetch responses, keyed by PMID and stored in SQLite
+
+    The HTTP cache keeps responses by the URL of their batch, which changes
+    with the batch whenever the source, the resumed items or the batch size
+    differ, so articles are cached by PMID as well. An article older than
+    `ttl` is fetched again, unless `offline`.
+    """
+
+    def __init__(self, path, ttl=ARTICLE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(ARTICLE_SCHEMA)
+
+    def get(self, pmids, offline=False) -> Dict[int, Dict]:
+        """
+        Cached articles of PMIDs, keyed by PMID
+        """
+        pmids = list(pmids)
+        since = 0 if offline else time.time() - self.ttl
+        result = {}
+        # Stay below the limit of SQLite variables
+        for start in range(0, len(pmids), 500):
+            chunk = pmids[start:start + 500]
+            rows = self.conn.execute(
+                'SELECT pmid, record FROM articles WHERE fetched_at >= ? AND pmid IN ({})'.format(
+                    ','.join('?' * len(chunk))), [since] + chunk)
+            for pmid, record in rows:
+                result[pmid] = json.loads(record)
+        return result
+
+    def put(self, articles):
+        now = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO articles VALUES (?, ?, ?)', [
+            (article['pmid'], json.dumps(article), now) for article in articles])
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
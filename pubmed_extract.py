@@ -0,0 +1,267 @@
+import os
+import json
+import math
+import time
+import shutil
+import signal
+import hashlib
+import asyncio
+import logging as log
+from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pubmed_store as store
+
+# Limits of a document extracted in the process pool
+TIMEOUT = 300
+MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
+# Documents longer than this are split into page ranges extracted in parallel
+SHARD_PAGES = 50
+HASH_CHUNK_SIZE = 1024 * 1024
+SETTINGS = None
+
+
+def get_settings() -> str:
+    """
+    Settings the extracted text depends on, besides the PDF
+    """
+    global SETTINGS
+    if SETTINGS is None:
+        import pdfminer
+        from pdfminer.layout import LAParams
+        SETTINGS = json.dumps({
+            'pdfminer': getattr(pdfminer, '__version__', ''),
+            'laparams': vars(LAParams())
+        }, sort_keys=True, default=str)
+    return SETTINGS
+
+
+class ExtractTimeout(Exception):
+    pass
+
+
+def count_pages(pdf_path) -> int:
+    """
+    Count pages of a PDF from its page tree, 0 if unknown
+    """
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdftypes import resolve1
+    try:
+        with open(pdf_path, 'rb') as f:
+            document = PDFDocument(PDFParser(f))
+            return int(resolve1(resolve1(document.catalog['Pages'])['Count']))
+    except Exception as e:
+        log.debug("Unable to count pages of %s: %s", pdf_path, e)
+        return 0
+
+
+def extract_text(pdf_path, start=0, stop=None) -> str:
+    """
+    Extract text of a PDF with pdfminer, only pages from start to stop if given
+
+    Every page is rendered independently and terminated by a form feed, so
+    joining the texts of consecutive page ranges gives the text of the whole.
+    """
+    from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfpage import PDFPage
+    resourceManager = PDFResourceManager()
+    strIo = StringIO()
+    device = TextConverter(resourceManager, strIo, laparams=LAParams())
+    interpreter = PDFPageInterpreter(resourceManager, device)
+    with open(pdf_path, 'rb') as f:
+        for pageno, page in enumerate(PDFPage.get_pages(f)):
+            if stop is not None and pageno >= stop:
+                break
+            if pageno >= start:
+                interpreter.process_page(page)
+        content = strIo.getvalue()
+    device.close()
+    strIo.close()
+    return content
+
+
+def extract_to(pdf_path, dest):
+    """
+    Extract text of a PDF to the file dest
+    """
+    content = extract_text(pdf_path)
+    with open(dest, 'w') as f:
+        f.write(content)
+
+
+def on_alarm(signum, frame):
+    raise ExtractTimeout()
+
+
+def init_worker(memory_limit):
+    if memory_limit:
+        try:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        except Exception as e:
+            log.warning("Unable to limit memory of extracting process: %s", e)
+    if hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, on_alarm)
+
+
+def run_job(deadline, func, *args):
+    """
+    Run a job in the worker process, interrupted at the deadline in epoch seconds
+    """
+    alarm = deadline and hasattr(signal, 'SIGALRM')
+    if alarm:
+        left = math.ceil(deadline - time.time())
+        if left <= 0:
+            raise ExtractTimeout()
+        signal.alarm(left)
+    try:
+        return func(*args)
+    finally:
+        if alarm:
+            signal.alarm(0)
+
+
+class ExtractPool:
+    """
+    Process pool extracting text of PDFs, apart from the event loop
+    """
+
+    def __init__(self, procs, timeout=TIMEOUT, memory_limit=MEMORY_LIMIT, shard_pages=SHARD_PAGES):
+        self.procs = procs
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.shard_pages = shard_pages
+        self.executor = None
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.procs, initializer=init_worker,
+                                            initargs=(self.memory_limit,))
+
+    async def run(self, deadline, func, *args):
+        """
+        Run func in the pool, interrupted at the deadline in epoch seconds
+        """
+        if self.executor is None:
+            self.start()
+        executor = self.executor
+        try:
+            return await self.run_in(executor, deadline, func, *args)
+        except BrokenProcessPool:
+            # A worker died, probably killed for its memory, restart the pool
+            if self.executor is executor:
+                log.warning("An extracting process died, restart pool")
+                executor.shutdown(wait=False)
+                self.executor = None
+        # Every job in flight fails with the pool, not only the one killing it,
+        # so each of them is run again in a process of its own
+        executor = ProcessPoolExecutor(max_workers=1, initializer=init_worker,
+                                       initargs=(self.memory_limit,))
+        try:
+            return await self.run_in(executor, deadline, func, *args)
+        finally:
+            executor.shutdown(wait=False)
+
+    async def run_in(self, executor, deadline, func, *args):
+        future = asyncio.get_running_loop().run_in_executor(executor, run_job, deadline, func, *args)
+        try:
+            # The alarm in worker should fire first, this is the last resort
+            return await asyncio.wait_for(future, deadline - time.time() + 30 if deadline else None)
+        except asyncio.TimeoutError:
+            raise ExtractTimeout(f"Extracting {args[0]} exceeds {self.timeout}s")
+
+    async def extract_to(self, pdf_path, dest):
+        """
+        Extract text of a PDF to the file dest in the pool, raise if failed
+
+        The timeout applies to the whole document, however many shards it has.
+        """
+        deadline = time.time() + self.timeout if self.timeout else None
+        pages = 0
+        if self.shard_pages:
+            pages = await self.run(deadline, count_pages, pdf_path)
+        if pages <= self.shard_pages:
+            await self.run(deadline, extract_to, pdf_path, dest)
+            return
+        # Extract page ranges in parallel, and join them in order. The count
+        # of the page tree may be wrong, so the last range is open-ended
+        shards = [(start, start + self.shard_pages) for start in range(0, pages, self.shard_pages)]
+        shards[-1] = (shards[-1][0], None)
+        log.debug("Extract %s of %d pages in %d shards", pdf_path, pages, len(shards))
+        texts = await asyncio.gather(*[self.run(deadline, extract_text, pdf_path, start, stop)
+                                       for start, stop in shards])
+        with open(dest, 'w') as f:
+            f.write(''.join(texts))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def hash_file(path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class ExtractCache:
+    """
+    Content-addressed cache of extracted text
+
+    Texts are stored under the hash of the PDF content and SETTINGS, so a PDF
+    is extracted again only if its content or the settings change. Hashes of
+    PDFs are saved in a manifest, and reused while the size and mtime of the
+    file are unchanged.
+    """
+
+    def __init__(self, cache_dir, manifest_path):
+        self.cache_dir = cache_dir
+        self.manifest = {}
+        if os.path.exists(manifest_path):
+            for record in store.iter_json_lines(manifest_path):
+                self.manifest[record['path']] = record
+        os.makedirs(cache_dir, exist_ok=True)
+        self.sink = store.JsonLinesSink(manifest_path)
+
+    async def key_of(self, pdf_path) -> str:
+        path = os.path.abspath(pdf_path)
+        stat = os.stat(path)
+        record = self.manifest.get(path)
+        if record is None or record['size'] != stat.st_size or record['mtime_ns'] != stat.st_mtime_ns:
+            record = {
+                'path': path,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sha256': await asyncio.get_running_loop().run_in_executor(None, hash_file, path)
+            }
+            self.manifest[path] = record
+            self.sink.write(record)
+        return hashlib.sha256((record['sha256'] + get_settings()).encode()).hexdigest()
+
+    def path_of(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.txt')
+
+    def get(self, key, dest) -> bool:
+        """
+        Copy the cached text to dest, False if not cached
+        """
+        cached = self.path_of(key)
+        if not os.path.exists(cached):
+            return False
+        shutil.copyfile(cached, dest)
+        return True
+
+    def put(self, key, text_path):
+        cached = self.path_of(key)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp_path = cached + '.tmp'
+        shutil.copyfile(text_path, tmp_path)
+        os.replace(tmp_path, cached)
+
+    def close(self):
+        self.sink.close()
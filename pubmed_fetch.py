@@ -0,0 +1,472 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging as log
+import traceback
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+import pubmed_cache
+import pubmed_limit as limit
+import pubmed_proxy
+
+PROXY_POOL_BASE = 'http://118.24.52.95'
+PROXY_POOL_SIZE = pubmed_proxy.POOL_SIZE
+PROXY_CONCURRENCY = pubmed_proxy.CONCURRENCY
+TIMEOUT = 30
+# Slow proxies are given up quickly, another one is tried instead
+PROXY_TIMEOUT = 10
+RETRY_COUNT = 5
+# Backoff between retries, in seconds
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Initial request rate per host, adapted to throttling responses
+RATE = 3.0
+# Directory sharing rate limits among processes, None for this process only
+RATE_STATE_DIR = None
+# Connection pool
+POOL_LIMIT = 100
+POOL_LIMIT_PER_HOST = 8
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+# Disable progress bar for non-TTY batch runs
+SHOW_PROGRESS = sys.stdout.isatty()
+PROGRESS_INTERVAL = 0.5
+# Chunk size grows while the network keeps up with it
+CHUNK_SIZE_MIN = 64 * 1024
+CHUNK_SIZE_MAX = 1024 * 1024
+WRITE_BUFFER = 1024 * 1024
+FSYNC = True
+VALIDATOR_SUFFIX = '.validator'
+
+# A few common browsers, picked once per process
+USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/17.4 Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0',
+)
+USER_AGENT = random.choice(USER_AGENTS)
+
+Response = namedtuple('Response', ['url', 'status_code', 'headers', 'content'])
+
+# HTTP cache of pages, opened by run() if CACHE_PATH is set
+CACHE_PATH = None
+# Serve pages from the cache only, never touch the network
+OFFLINE = False
+cache = None
+session = None
+limiters = {}
+proxies = None
+
+
+class RetryExceeded(Exception):
+    pass
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+class Progress:
+    """
+    Progress bar of a download, redrawn at most once every PROGRESS_INTERVAL
+    """
+
+    def __init__(self, done=0, total=None):
+        self.enabled = SHOW_PROGRESS
+        self.done = done
+        self.total = total
+        self.drawn_at = None
+
+    def update(self, size):
+        self.done += size
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if self.drawn_at is not None and now - self.drawn_at < PROGRESS_INTERVAL:
+            return
+        self.drawn_at = now
+        self.draw()
+
+    def draw(self):
+        if self.total:
+            done = int(50 * self.done / self.total)
+            sys.stdout.write('\r[%s%s] %.2f%%' % (
+                '=' * done, ' ' * (50 - done), 100 * self.done / self.total))
+        else:
+            sys.stdout.write('\r%d bytes' % self.done)
+        sys.stdout.flush()
+
+    def close(self):
+        if self.enabled and self.drawn_at is not None:
+            self.draw()
+            print()
+
+
+def open_session() -> 'aiohttp.ClientSession':
+    """
+    Open the session shared by all fetches, must be called inside the event loop
+
+    Connections are kept alive and pooled by the connector. The pool is keyed
+    by host, port, ssl and proxy, so a connection opened through one proxy is
+    never reused for a direct request or another proxy.
+    """
+    import aiohttp
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_LIMIT,
+                                         limit_per_host=POOL_LIMIT_PER_HOST,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT,
+                                         ttl_dns_cache=DNS_CACHE_TTL)
+        timeout = aiohttp.ClientTimeout(total=None, connect=TIMEOUT, sock_read=TIMEOUT)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                        headers={'User-Agent': USER_AGENT})
+    return session
+
+
+async def close_session():
+    global session
+    if session is not None:
+        await session.close()
+        session = None
+
+
+def open_cache(readonly=False):
+    """
+    Open the HTTP cache at CACHE_PATH, None if not configured
+    """
+    global cache
+    if CACHE_PATH and cache is None:
+        cache = pubmed_cache.ResponseCache(CACHE_PATH, readonly=readonly)
+    return cache
+
+
+def run(main):
+    """
+    Run coroutine `main` in an event loop, with the shared session opened
+    """
+    global cache
+
+    async def wrapper():
+        # The session is opened by the first request, never in offline runs
+        try:
+            return await main
+        finally:
+            await close_proxies()
+            await close_session()
+
+    open_cache()
+    try:
+        return asyncio.run(wrapper())
+    finally:
+        if cache is not None:
+            cache.close()
+            cache = None
+
+
+def add_fetch_arguments(parser):
+    """
+    Add the options of fetching shared by the scripts to parser
+    """
+    parser.add_argument('--proxy-pool-size', dest='proxy_pool_size', action='store', type=int,
+                        default=PROXY_POOL_SIZE, help='Number of proxies kept ready')
+    parser.add_argument('--proxy-concurrency', dest='proxy_concurrency', action='store', type=int,
+                        default=PROXY_CONCURRENCY, help='Requests sent through a proxy at the same time')
+    parser.add_argument('--rate', dest='rate', action='store', type=float, default=RATE,
+                        help='Initial requests per second to a host, adapted when throttled')
+    parser.add_argument('--rate-state-dir', dest='rate_state_dir', action='store',
+                        help='Directory sharing the rate limits with other processes')
+    parser.add_argument('--http-cache', dest='http_cache', action='store', metavar='CACHE_FILE',
+                        default='http_cache.sqlite', help='File caching fetched pages')
+    parser.add_argument('--no-http-cache', dest='no_http_cache', action='store_true',
+                        help='Always fetch pages from server, without caching')
+
+
+def configure(args, parser):
+    """
+    Apply the options added by add_fetch_arguments()
+    """
+    global PROXY_POOL_SIZE, PROXY_CONCURRENCY, RATE, RATE_STATE_DIR, CACHE_PATH
+    PROXY_POOL_SIZE = max(1, args.proxy_pool_size)
+    PROXY_CONCURRENCY = max(1, args.proxy_concurrency)
+
+    if args.rate <= 0:
+        parser.error('--rate must be positive')
+    RATE = args.rate
+    RATE_STATE_DIR = args.rate_state_dir
+
+    if not args.no_http_cache:
+        CACHE_PATH = args.http_cache
+
+
+def get_proxies() -> pubmed_proxy.ProxyPool:
+    global proxies
+    if proxies is None:
+        proxies = pubmed_proxy.ProxyPool(PROXY_POOL_BASE, open_session,
+                                         size=PROXY_POOL_SIZE, concurrency=PROXY_CONCURRENCY)
+    return proxies
+
+
+async def close_proxies():
+    global proxies
+    if proxies is not None:
+        await proxies.close()
+        proxies = None
+
+
+async def retry(action, url, use_proxy=False):
+    """
+    Await `action(proxy)` until it succeeds, with another proxy after each failure
+    """
+    err = None
+    failed = set()
+    for attempt in range(RETRY_COUNT):
+        proxy = await get_proxies().acquire(exclude=failed) if use_proxy else None
+        ok = False
+        try:
+            result = await action(proxy.url if proxy else None)
+            ok = True
+            return result
+        except Exception as e:
+            err = e
+            log.debug("Problem in fetching url %s: %s", url, e)
+        finally:
+            if proxy is not None:
+                await get_proxies().release(proxy, ok)
+                if not ok:
+                    failed.add(proxy.url)
+        if attempt + 1 < RETRY_COUNT:
+            await asyncio.sleep(backoff(attempt, err))
+    raise RetryExceeded(f"Maximum retries count exceed for {url}") from err
+
+
+def get_limiter(url) -> limit.HostLimiter:
+    host = urlsplit(url).netloc
+    if host not in limiters:
+        limiters[host] = limit.HostLimiter(host, RATE, POOL_LIMIT_PER_HOST, state_dir=RATE_STATE_DIR)
+    return limiters[host]
+
+
+@asynccontextmanager
+async def request(url, headers=None, proxy=None):
+    """
+    Send GET request within the rate limit of the host, raise if throttled
+    """
+    import aiohttp
+    limiter = get_limiter(url)
+    await limiter.acquire()
+    kwargs = {}
+    if proxy is not None:
+        kwargs['timeout'] = aiohttp.ClientTimeout(total=None, connect=PROXY_TIMEOUT, sock_read=TIMEOUT)
+    try:
+        started = time.monotonic()
+        async with open_session().get(url, headers=headers, proxy=proxy, **kwargs) as r:
+            if proxy is not None and proxies is not None:
+                proxies.observe_latency(proxy, time.monotonic() - started)
+            retry_after = r.headers.get('Retry-After')
+            limiter.feedback(r.status, retry_after)
+            if r.status in limit.THROTTLE_STATUS:
+                raise limit.RateLimited(url, r.status, limit.parse_retry_after(retry_after))
+            yield r
+    finally:
+        await limiter.release()
+
+
+def backoff(attempt, err) -> float:
+    """
+    Seconds to wait before the next attempt, with jitter
+    """
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+    if isinstance(err, limit.RateLimited) and err.retry_after is not None:
+        delay = max(delay, err.retry_after)
+    return delay
+
+
+def cached_response(entry):
+    from multidict import CIMultiDict
+    return Response(entry['url'], entry['status_code'], CIMultiDict(entry['headers']), entry['content'])
+
+
+async def get_html(url, use_proxy=False):
+    """
+    Get html from url, through the HTTP cache if opened
+    """
+    entry = cache.get(url) if cache is not None else None
+    if entry is not None and (entry['fresh'] or OFFLINE):
+        return cached_response(entry)
+    if OFFLINE:
+        log.warning("Page not cached: %s, skipped in offline mode.", url)
+        return ''
+    # Revalidate stale response
+    headers = {}
+    if entry is not None:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    async def action(proxy):
+        async with request(url, headers=headers, proxy=proxy) as r:
+            if r.status == 304 and entry is not None:
+                cache.touch(url)
+                return cached_response(entry)
+            content = await r.read()
+            if r.status == 200 and cache is not None:
+                cache.put(url, str(r.url), r.status, list(r.headers.items()), content)
+            return Response(str(r.url), r.status, r.headers, content)
+
+    try:
+        return await retry(action, url, use_proxy=use_proxy)
+    except RetryExceeded:
+        log.warning("Fail to get url: %s, maximum retries count exceed.", url)
+        return ''
+
+
+def parse_content_range(value):
+    """
+    Parse `Content-Range` header into (start, total), None if unknown
+    """
+    try:
+        unit, _, spec = value.strip().partition(' ')
+        if unit != 'bytes':
+            return None, None
+        span, _, total = spec.partition('/')
+        start = None if span == '*' else int(span.split('-')[0])
+        total = None if total == '*' else int(total)
+        return start, total
+    except Exception:
+        return None, None
+
+
+def load_validator(file_path):
+    """
+    Load the validator saved along with a partially downloaded file
+    """
+    try:
+        with open(file_path + VALIDATOR_SUFFIX, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def save_validator(file_path, headers):
+    etag = headers.get('ETag')
+    # Weak ETag cannot be used in If-Range
+    if etag is not None and etag.startswith('W/'):
+        etag = None
+    validator = {
+        'etag': etag,
+        'last_modified': headers.get('Last-Modified')
+    }
+    with open(file_path + VALIDATOR_SUFFIX, 'w') as f:
+        json.dump(validator, f)
+
+
+def clear_validator(file_path):
+    if os.path.exists(file_path + VALIDATOR_SUFFIX):
+        os.unlink(file_path + VALIDATOR_SUFFIX)
+
+
+async def download_part(file_path, url, proxy=None) -> bool:
+    """
+    Download the rest of the partial file by one request
+
+    Returns False if the remote file has changed, and must be downloaded again.
+    """
+    if os.path.exists(file_path):
+        temp_size = os.path.getsize(file_path)  # already downloaded
+    else:
+        temp_size = 0
+    # Byte ranges must refer to the raw file, not a compressed transfer
+    headers = {'Accept-Encoding': 'identity'}
+    if temp_size > 0:
+        headers['Range'] = 'bytes=%d-' % temp_size
+        validator = load_validator(file_path)
+        if_range = validator.get('etag') or validator.get('last_modified')
+        if if_range:
+            headers['If-Range'] = if_range
+    async with request(url, headers=headers, proxy=proxy) as r:
+        if r.status == 416:
+            _, total_size = parse_content_range(r.headers.get('Content-Range', ''))
+            if total_size is not None and total_size != temp_size:
+                return False
+            clear_validator(file_path)
+            return True
+        r.raise_for_status()
+        if r.status == 206:
+            start, total_size = parse_content_range(r.headers.get('Content-Range', ''))
+            if start != temp_size:
+                raise IncompleteDownload(
+                    f"Unexpected range {r.headers.get('Content-Range')} for {url}")
+            mode = 'ab'
+        else:
+            # Range ignored, or remote file changed
+            temp_size = 0
+            total_size = r.content_length
+            mode = 'wb'
+        save_validator(file_path, r.headers)
+        progress = Progress(temp_size, total_size)
+        chunk_size = CHUNK_SIZE_MIN
+        with open(file_path, mode, buffering=WRITE_BUFFER) as f:
+            try:
+                while True:
+                    chunk = await r.content.read(chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    progress.update(len(chunk))
+                    if len(chunk) == chunk_size and chunk_size < CHUNK_SIZE_MAX:
+                        chunk_size *= 2
+            finally:
+                progress.close()
+            temp_size = progress.done
+            if total_size is not None and temp_size < total_size:
+                raise IncompleteDownload(f"Incomplete download {temp_size}/{total_size} for {url}")
+            # Commit point
+            f.flush()
+            if FSYNC:
+                os.fsync(f.fileno())
+    clear_validator(file_path)
+    return True
+
+
+async def download(file_path, url, proxy=None):
+    """
+    Download url to file_path, resuming the partial file
+
+    The partial file is resumed by a ranged request, guarded by If-Range with
+    the validator saved at its first response, so the server answers 206 with
+    the rest of the same file, or 200 with the whole file if it has changed.
+    416 means nothing is left, and the file is complete.
+    """
+    while not await download_part(file_path, url, proxy=proxy):
+        # Remote file changed, start over once the connection is released
+        log.debug("Remote file of %s changed, download again", url)
+        open(file_path, 'wb').close()
+        clear_validator(file_path)
+
+
+async def download_to(url, file_path, use_proxy=False) -> bool:
+    """
+    Download url to file_path, resuming from the partially downloaded file
+    """
+    if OFFLINE:
+        # Only files completely downloaded before are available
+        return os.path.exists(file_path) and not os.path.exists(file_path + VALIDATOR_SUFFIX)
+    try:
+        await retry(lambda proxy: download(file_path, url, proxy=proxy), url, use_proxy=use_proxy)
+        return True
+    except RetryExceeded as e:
+        log.warning("Fail to download file: %s, maximum retries count exceed.", url)
+        log.warning("%s\n%s", e.__cause__, traceback.format_exc())
+        return False
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import logging as log
+from typing import Dict, List
+from urllib.parse import urlencode
+import pubmed_fetch as fetch
+import pubmed_store as store
+
+IDCONV_BASE = 'https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/'
+# IDs converted by a request, limited by the service
+BATCH_SIZE = 200
+TOOL = 'PubmedToolkit'
+# PMIDs without PMC copy are checked again after this, in seconds
+MISS_TTL = 30 * 24 * 3600
+# Error message of records without PMC copy, other errors and PMIDs missing
+# from the response are left unresolved
+NOT_FOUND = 'not found'
+
+
+def idconv_url(pmids) -> str:
+    params = {
+        'ids': ','.join(pmids),
+        'idtype': 'pmid',
+        'format': 'json',
+        'versions': 'no',
+        'tool': TOOL
+    }
+    return '{}?{}'.format(IDCONV_BASE, urlencode(params, safe=','))
+
+
+async def fetch_pmcids(pmids, use_proxy=False) -> Dict[str, str]:
+    """
+    Convert PMIDs to PMCIDs by one request, None for PMIDs without PMC copy
+
+    PMIDs with an error other than not found, or missing from the response,
+    are not returned. Returns None if the request failed.
+    """
+    response = await fetch.get_html(idconv_url(pmids), use_proxy=use_proxy)
+    if not response or response.status_code != 200:
+        log.warning("Failed to convert %d PMIDs to PMCIDs.", len(pmids))
+        return None
+    try:
+        records = json.loads(response.content)['records']
+    except Exception as e:
+        log.warning("Invalid ID converter response for %d PMIDs: %s", len(pmids), e)
+        return None
+    requested = set(pmids)
+    result = {}
+    for record in records:
+        pmid = str(record.get('pmid') or record.get('requested-id'))
+        if pmid not in requested:
+            continue
+        if record.get('pmcid'):
+            result[pmid] = record['pmcid']
+        elif record.get('status') == 'error' and NOT_FOUND in record.get('errmsg', '').lower():
+            result[pmid] = None
+        else:
+            log.debug("Unable to convert pmid %s: %s", pmid, record.get('errmsg'))
+    return result
+
+
+class IdConverter:
+    """
+    PMID to PMCID converter, caching the conversions in a JSON Lines file
+
+    PMIDs without PMC copy are cached as well, and checked again after
+    MISS_TTL, since articles may be deposited into PMC later.
+    """
+
+    def __init__(self, cache_path):
+        self.records = {}
+        if os.path.exists(cache_path):
+            for record in store.iter_json_lines(cache_path):
+                self.records[record['pmid']] = record
+        self.sink = store.JsonLinesSink(cache_path)
+
+    def cached(self, pmid):
+        record = self.records.get(pmid)
+        if record is None:
+            return False
+        return record['pmcid'] is not None or time.time() - record['checked_at'] < MISS_TTL
+
+    async def resolve(self, pmids: List[str], use_proxy=False) -> Dict[str, str]:
+        """
+        Resolve PMCIDs of PMIDs, None for PMIDs without PMC copy
+
+        PMIDs failed to resolve are not returned.
+        """
+        missing = [pmid for pmid in dict.fromkeys(pmids) if not self.cached(pmid)]
+        for start in range(0, len(missing), BATCH_SIZE):
+            pmcids = await fetch_pmcids(missing[start:start + BATCH_SIZE], use_proxy=use_proxy)
+            if pmcids is None:
+                continue
+            now = time.time()
+            for pmid, pmcid in pmcids.items():
+                record = {'pmid': pmid, 'pmcid': pmcid, 'checked_at': now}
+                self.records[pmid] = record
+                self.sink.write(record)
+        return {pmid: self.records[pmid]['pmcid'] for pmid in pmids if self.cached(pmid)}
+
+    def close(self):
+        self.sink.close()
@@ -0,0 +1,106 @@
+import os
+import asyncio
+import uuid
+import logging as log
+from urllib.parse import urlparse
+import pubmed_fetch as fetch
+import pubmed_store as store
+import pubmed_extract as extract
+
+# Hex digits of the hash naming each level of directories
+SHARD_WIDTH = 2
+SHARD_DEPTH = 2
+TEMP_DIR = 'tmp'
+
+
+def extension_of(url) -> str:
+    ext = os.path.splitext(urlparse(url).path)[1].lower()
+    return ext if 1 < len(ext) <= 5 else ''
+
+
+class ImageStore:
+    """
+    Content-addressed store of images, shared by all articles
+
+    Images are stored once under the SHA-256 of their content, in directories
+    sharded by hash prefix, so identical images of different articles take
+    the space of one, and no directory grows too large. Hashes of downloaded
+    URLs are saved in an index, and an image known by the index is never
+    downloaded again.
+    """
+
+    def __init__(self, store_dir, index_path):
+        self.store_dir = store_dir
+        self.index = {}
+        if os.path.exists(index_path):
+            for record in store.iter_json_lines(index_path):
+                self.index[record['url']] = record
+        os.makedirs(os.path.join(store_dir, TEMP_DIR), exist_ok=True)
+        self.index_path = index_path
+        self.sink = None
+        # Downloads in progress, so an image used by several articles at the
+        # same time is downloaded once
+        self.pending = {}
+
+    def path_of(self, digest, ext=''):
+        shards = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+        return os.path.join(self.store_dir, *shards, digest + ext)
+
+    def lookup(self, url):
+        """
+        Record of url in the index, None if unknown or its image is missing
+        """
+        record = self.index.get(url)
+        if record is None or not os.path.exists(self.path_of(record['sha256'], record['ext'])):
+            return None
+        return record
+
+    async def fetch(self, url, download):
+        """
+        Record of the image of url, downloaded by `download(path)` if unknown
+
+        `download` returns whether the image is completely downloaded to path.
+        Returns None if failed.
+        """
+        record = self.lookup(url)
+        if record is not None:
+            return record
+        if url not in self.pending:
+            self.pending[url] = asyncio.ensure_future(self.download(url, download))
+            self.pending[url].add_done_callback(lambda _: self.pending.pop(url, None))
+        return await asyncio.shield(self.pending[url])
+
+    async def download(self, url, download):
+        ext = extension_of(url)
+        # Unique to the download, as the store may be shared by other processes
+        temp_path = os.path.join(self.store_dir, TEMP_DIR, uuid.uuid4().hex + ext)
+        try:
+            if not await download(temp_path):
+                return None
+            digest = await asyncio.get_running_loop().run_in_executor(None, extract.hash_file, temp_path)
+            path = self.path_of(digest, ext)
+            if os.path.exists(path):
+                log.debug("Image of %s is stored already as %s", url, digest)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            fetch.clear_validator(temp_path)
+        record = {
+            'url': url,
+            'sha256': digest,
+            'ext': ext,
+            'size': os.path.getsize(path)
+        }
+        self.index[url] = record
+        if self.sink is None:
+            # Flushed at once, since other processes write to the index as well
+            self.sink = store.JsonLinesSink(self.index_path, flush_every=1, shared=True)
+        self.sink.write(record)
+        return record
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
@@ -1,273 +1,310 @@
 import os
-import sys
 import json
-import requests
+import shutil
+import asyncio
 import logging as log
 import traceback
-import time
-import string
 import argparse as arg
-from typing import List, Tuple, Dict
-from lxml import etree
-from fake_useragent import UserAgent
-from bs4 import BeautifulSoup
-from io import StringIO
-from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.converter import TextConverter
-from pdfminer.layout import LAParams
-from pdfminer.pdfpage import PDFPage
+from typing import List, Dict, Iterator, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import pubmed_fetch as fetch
+import pubmed_journal as journal
+import pubmed_store as store
+import pubmed_extract as extract
+import pubmed_eutils as eutils
+import pubmed_source as sources
+import pubmed_pipeline as pipeline
+import pubmed_images as images
 
 PDF_BASE = 'https://www.ncbi.nlm.nih.gov/'
 USE_PROXY = False
 OUTPUT_DIR = 'info/'
-PROXY_POOL_BASE = 'http://118.24.52.95'
 PMID_SOURCE = ''
 LOCKFILE = 'pubmed_info.lock'
 FAILEDFILE = 'failed.json'
-REQUESTS_PARAM = {
-    'timeout': 30
-}
+JOURNAL = None
 
 OPTION_MESH = True
 OPTION_PIC = True
 OPTION_PDF = True
+# Fetch MeSH terms by batched E-utilities requests instead of PubMed pages
+USE_EUTILS = True
 
 log.basicConfig(level=log.INFO,
                 format='%(asctime)s:%(lineno)d - %(levelname)s: %(message)s')
 
-ua = UserAgent()
-USER_AGENT = ua.random
 
-cur_proxy = None
-fetch_count = 0
-
-def get_proxy(refresh=False):
-    global cur_proxy
-    global fetch_count
-    if cur_proxy is None or refresh or fetch_count > 10:
-        try:
-            cur_proxy = requests.get(f"{PROXY_POOL_BASE}/get/").json().get('proxy')
-            log.info("Renew proxy %s", cur_proxy)
-        except Exception:      
-            time.sleep(30)
-            get_proxy(refresh=True)
-        fetch_count = 10
-    fetch_count += 1
-    return cur_proxy
-
-
-def delete_proxy():
-    requests.get('{}/get/delete/?proxy={}'.format(PROXY_POOL_BASE, cur_proxy))
-
-
-def get_html(url, use_proxy=USE_PROXY):
-    """
-    Get html from url
-    """
-    retry_count = 5
-    # Proxy config
-    if use_proxy:
-        proxy = get_proxy()
-        proxies = {'http': 'http://{}'.format(proxy)}
-    else:
-        proxies = None
-    # Headers
-    headers = {
-        'User-Agent': USER_AGENT
-    }
-    # Start
-    while retry_count > 0:
-        try:
-            html = requests.get(url, proxies=proxies, headers=headers, **REQUESTS_PARAM)
-            return html
-        except Exception as e:
-            retry_count -= 1
-            log.debug("Probleam in fetching url %s: %s", url, e)
-            # Refresh proxy
-            if use_proxy:
-                proxy = get_proxy(refresh=True)
-                proxies = {'http': 'http://{}'.format(proxy)}
-    # Delete proxy
-    if use_proxy:
-        delete_proxy()
-    log.warning("Fail to get url: %s, maximum retries count exceed.", url)
-    return ''
-
-
-def download(file_path, url, headers=None, proxies=None):
-    # Check file size
-    r1 = requests.get(url, stream=True, headers=headers, proxies=proxies, **REQUESTS_PARAM)
-    total_size = int(r1.headers['Content-Length'])
-    if os.path.exists(file_path):
-        temp_size = os.path.getsize(file_path)  # already downloaded
-    else:
-        temp_size = 0
-    if temp_size >= total_size:
-        return
-    # Continue download
-    headers['Range'] = 'bytes=%d-' % temp_size
-    r = requests.get(url, stream=True, headers=headers, proxies=proxies, **REQUESTS_PARAM)
-    with open(file_path, 'ab') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                temp_size += len(chunk)
-                f.write(chunk)
-                f.flush()
-                done = int(50 * temp_size / total_size)
-                sys.stdout.write('\r[%s%s] %.2f%%' % (
-                    '=' * done, ' ' * (50 - done), 100 * temp_size / total_size))
-                sys.stdout.flush()
-    print()
-
-
-def download_to(url, pmid, filename, path='./', use_proxy=USE_PROXY):
-    if not os.path.exists(OUTPUT_DIR):
-        os.mkdir(OUTPUT_DIR)
-    path = os.path.join(OUTPUT_DIR, path)
-    if not os.path.exists(path):
-        os.mkdir(path)
-    filename = path + filename
-    # Proxy config
-    if use_proxy:
-        proxy = get_proxy()
-        proxies = {'http': 'http://{}'.format(proxy)}
-    else:
-        proxies = None
-    # Headers
-    headers = {
-        'User-Agent': USER_AGENT
-    }
-    # Download
-    retry_count = 5
-    err = None
-    while retry_count > 0:
-        try:
-            download(filename, url, headers=headers, proxies=proxies)
-            return filename
-        except Exception as e:
-            err = e
-            retry_count -= 1
-            # Refresh proxy
-            if use_proxy:
-                proxy = get_proxy(refresh=True)
-                proxies = {'http': 'http://{}'.format(proxy)}
-    if use_proxy:
-        delete_proxy()
-    log.warning("Fail to download file: %s, maximum retries count exceed.", url)
-    log.warning("%s\n%s", err, traceback.format_exc())
-    return False
-
-
-def get_pubmed_html(pmid):
+async def get_pubmed_html(pmid):
     url = f'https://pubmed.ncbi.nlm.nih.gov/{pmid}/'
-    response = get_html(url, use_proxy=USE_PROXY)
-    if not response or response.status_code != requests.codes['\\o/']:
+    response = await fetch.get_html(url, use_proxy=USE_PROXY)
+    if not response or response.status_code != 200:
         log.warning("Failed to retrieve data from sever for pmid %d.", pmid)
         log.warning("This might be a temporary problem. Use argument --retry for a retry.")
         return None
     return response.content
 
-def write_json(data, flilename, type=''):
+MESH_SINK = None
+FIGURE_SINK = None
+ARTICLE_SINK = None
+ARTICLE_CACHE = None
+CONSOLIDATE = True
+SQLITE_PATH = None
+STORE = None
+IMAGE_STORE_DIR = None
+IMAGE_STORE = None
+
+
+def open_sinks():
+    global MESH_SINK, FIGURE_SINK
     if not os.path.exists(OUTPUT_DIR):
         os.mkdir(OUTPUT_DIR)
-    filename = os.path.join(OUTPUT_DIR, flilename)
     try:
-        with open(filename, 'w') as f:
-            json.dump(data, f)
+        if OPTION_MESH:
+            store.import_json_array(os.path.join(OUTPUT_DIR, 'mesh.json'),
+                                    os.path.join(OUTPUT_DIR, 'mesh.jsonl'))
+            MESH_SINK = store.JsonLinesSink(os.path.join(OUTPUT_DIR, 'mesh.jsonl'))
+        if OPTION_MESH and USE_EUTILS:
+            global ARTICLE_SINK, ARTICLE_CACHE
+            ARTICLE_SINK = store.JsonLinesSink(os.path.join(OUTPUT_DIR, 'article.jsonl'))
+            ARTICLE_CACHE = eutils.ArticleCache(os.path.join(OUTPUT_DIR, 'article_cache.sqlite'))
+        if OPTION_PIC:
+            store.import_json_array(os.path.join(OUTPUT_DIR, 'graph.json'),
+                                    os.path.join(OUTPUT_DIR, 'graph.jsonl'))
+            FIGURE_SINK = store.JsonLinesSink(os.path.join(OUTPUT_DIR, 'graph.jsonl'))
+            global IMAGE_STORE
+            image_dir = IMAGE_STORE_DIR or os.path.join(OUTPUT_DIR, 'images/')
+            IMAGE_STORE = images.ImageStore(image_dir, os.path.join(image_dir, 'index.jsonl'))
+        if SQLITE_PATH:
+            global STORE
+            STORE = store.SqliteStore(SQLITE_PATH)
+        if OPTION_PDF and USE_EXTRACT_CACHE:
+            global EXTRACT_CACHE
+            EXTRACT_CACHE = extract.ExtractCache(os.path.join(OUTPUT_DIR, 'text_cache/'),
+                                                 os.path.join(OUTPUT_DIR, 'text_manifest.jsonl'))
     except Exception as e:
-        log.error(f"Unable to write {type} result! %s", e)
+        log.error("Unable to open result file! %s", e)
         quit()
 
-MESH_RESULT = []
 
-def download_mesh(pubmed_html):
-    try:
-        # Get terms
-        meshes = []
-        soup = BeautifulSoup(pubmed_html, 'html.parser')
-        terms = soup.find(id="mesh-terms")
-        kw_lst = terms.find(class_="keywords-list")
-        for mesh_el in kw_lst.children:
-            mesh = mesh_el.find(class_="keyword-actions-dropdown")['aria-label']
-            if mesh is None:
-                continue
-            if mesh[-1] == '*':
-                meshes.append({
-                    'term': mesh[:-1],
-                    'major': True
-                })
-            else:
-                meshes.append({
-                    'term': mesh,
-                    'major': False
-                })
-    except Exception as e:
-        log.warning("Error in searching mesh for pmid %d", pmid)
-        log.warning("%s\n%s", e, traceback.format_exc())
-        return False
-    # Save
-    MESH_RESULT.append({
-        'pmid': pmid,
-        'mesh': meshes
-    })
-    write_json(MESH_RESULT, 'mesh.json', 'mesh')
-    return True
+def close_sinks():
+    """
+    Flush results, and consolidate them into JSON arrays if required
+    """
+    for sink, filename in [(MESH_SINK, 'mesh.json'), (FIGURE_SINK, 'graph.json'),
+                           (ARTICLE_SINK, 'article.json')]:
+        if sink is None:
+            continue
+        sink.close()
+        if not CONSOLIDATE:
+            continue
+        try:
+            # Items retried are written again, their last records win
+            store.consolidate(sink.path, os.path.join(OUTPUT_DIR, filename), key='pmid')
+        except Exception as e:
+            log.error("Unable to write %s! %s", filename, e)
+    if STORE is not None:
+        STORE.close()
+    if EXTRACT_CACHE is not None:
+        EXTRACT_CACHE.close()
+    if IMAGE_STORE is not None:
+        IMAGE_STORE.close()
+    if ARTICLE_CACHE is not None:
+        ARTICLE_CACHE.close()
+
+
+def parse_page(html):
+    """
+    Parse page with lxml, the tree is shared by all extractors of the page
+    """
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, 'lxml')
+
+
+def download_mesh(soup) -> List[Dict]:
+    # Get terms
+    meshes = []
+    terms = soup.find(id="mesh-terms")
+    kw_lst = terms.find(class_="keywords-list")
+    for mesh_el in kw_lst.children:
+        mesh = mesh_el.find(class_="keyword-actions-dropdown")['aria-label']
+        if mesh is None:
+            continue
+        if mesh[-1] == '*':
+            meshes.append({
+                'term': mesh[:-1],
+                'major': True
+            })
+        else:
+            meshes.append({
+                'term': mesh,
+                'major': False
+            })
+    return meshes
 
-FIGURE_RESULT = []
 
-def download_figure(pubmed_html):
-    # Search for figure
+def find_figures(soup) -> List[Dict]:
+    """
+    Find figures on the page, None if the page has no figure
+    """
+    figures_list = soup.find(class_='figures-list')
+    if not figures_list:
+        return None
     ret = []
-    try:
-        # Get figures-list
-        soup = BeautifulSoup(pubmed_html, 'html.parser')
-        figures_list = soup.find(class_='figures-list')
-        if not figures_list:
-            log.info("No figures for pmid %d", pmid)
+    for fig in figures_list.find_all('figure'):
+        ret.append({
+            'id': fig['data-label-slug'],
+            'url': fig.find(class_='figure-link')['href'],
+            'caption': fig.find('figcaption').find(class_='figure-caption-contents').get_text()
+        })
+    return ret
+
+
+async def download_image(pmid, fig) -> Dict:
+    """
+    Download image of a figure into the image store, None if failed
+    """
+    img_id = fig['id']
+    img_url = fig['url']
+    # Images named by PMID and figure, saved by older versions
+    legacy_path = os.path.join(OUTPUT_DIR, 'images/', f'{pmid}_{img_id}' + img_url[-4:])
+
+    async def download(path):
+        if os.path.exists(legacy_path) and not os.path.exists(legacy_path + fetch.VALIDATOR_SUFFIX):
+            shutil.copyfile(legacy_path, path)
             return True
+        async with get_figure_limit():
+            return await fetch.download_to(img_url, path, use_proxy=USE_PROXY)
 
-        figures = figures_list.find_all('figure')
-        for fig in figures:
-            img_id = fig['data-label-slug']
-            img_url = fig.find(class_='figure-link')['href']
-            caption = fig.find('figcaption').find(class_='figure-caption-contents').get_text()
-            dest_filename = f'{pmid}_{img_id}' + img_url[-4:]
-            dest = download_to(img_url, pmid, dest_filename, path='images/', use_proxy=USE_PROXY)
-            if not dest:
-                log.warning("Error in downloading figures %s for pmid %d", img_id, pmid)
-                return False
-            ret.append({
-                'id': img_id,
-                'url': img_url,
-                'caption': caption,
-                'local_path': dest
-            })
-    except Exception as e:
-        log.warning("Error in downloading figures for pmid %d", pmid)
-        log.warning("%s\n%s", e, traceback.format_exc())
-        return False
-    # Save
-    FIGURE_RESULT.append({
+    record = await IMAGE_STORE.fetch(img_url, download)
+    if record is None:
+        log.warning("Error in downloading figure %s from %s", img_id, img_url)
+        return None
+    return dict(fig, sha256=record['sha256'],
+                local_path=IMAGE_STORE.path_of(record['sha256'], record['ext']))
+
+
+async def download_figure(pmid, figures) -> Tuple[List[Dict], bool]:
+    """
+    Download images of figures concurrently, under the global FIGURE_DOWNLOADS limit
+
+    Figures are kept as their images finish, so a failed image does not lose
+    the others. Returns downloaded figures in page order, and whether all
+    images are downloaded.
+    """
+    done = {}
+
+    async def download(idx, fig):
+        try:
+            done[idx] = await download_image(pmid, fig)
+        except Exception as e:
+            log.warning("Error in downloading figure %s of pmid %d: %s", fig['id'], pmid, e)
+            done[idx] = None
+
+    await asyncio.gather(*[download(idx, fig) for idx, fig in enumerate(figures)])
+    ret = [done[idx] for idx in range(len(figures)) if done[idx] is not None]
+    return ret, len(ret) == len(figures)
+
+
+def parse_html(pmid, html, with_mesh, with_figures) -> Dict:
+    """
+    Parse PubMed page once, and run the enabled extractors on it
+
+    Runs in the parse pool if any, so only plain data is passed in and out.
+    Figures are found but not downloaded yet.
+    """
+    soup = parse_page(html)
+    result = {'ok': True, 'mesh': None, 'figures': None}
+    if with_mesh:
+        try:
+            result['mesh'] = download_mesh(soup)
+        except Exception as e:
+            log.warning("Error in searching mesh for pmid %d", pmid)
+            log.warning("%s\n%s", e, traceback.format_exc())
+            result['ok'] = False
+    if with_figures:
+        try:
+            result['figures'] = find_figures(soup)
+        except Exception as e:
+            log.warning("Error in searching figures for pmid %d", pmid)
+            log.warning("%s\n%s", e, traceback.format_exc())
+            result['ok'] = False
+    return result
+
+
+def save_result(pmid, result) -> bool:
+    if result['mesh'] is not None:
+        MESH_SINK.write({
+            'pmid': pmid,
+            'mesh': result['mesh']
+        })
+        if STORE is not None:
+            STORE.write_mesh(pmid, result['mesh'])
+    if result['figures'] is not None:
+        FIGURE_SINK.write({
+            'pmid': pmid,
+            'figures': result['figures']
+        })
+        if STORE is not None:
+            STORE.write_figures(pmid, result['figures'])
+    return result['ok']
+
+
+def save_article(pmid, article):
+    """
+    Save metadata of an article fetched from E-utilities
+    """
+    ARTICLE_SINK.write({
         'pmid': pmid,
-        'figures': ret
+        'title': article['title'],
+        'abstract': article['abstract']
     })
-    write_json(FIGURE_RESULT, 'graph.json', 'graph')
-    return True
+    if STORE is not None:
+        STORE.write_article(pmid, article['title'], article['abstract'])
+    save_result(pmid, {'ok': True, 'mesh': article['mesh'], 'figures': None})
 
-EXTRACT_RESULT = []
 
-def extract_text(pmid, pdf_path):
+async def fetch_articles(batch) -> Dict[int, Dict]:
+    """
+    Fetch metadata of a batch of items in one request, None if failed
+    """
+    if not (OPTION_MESH and USE_EUTILS):
+        return {}
+    pmids = [item['pmid'] for _, item in batch]
+    articles = ARTICLE_CACHE.get(pmids, offline=fetch.OFFLINE)
+    missing = [pmid for pmid in pmids if pmid not in articles]
+    if missing:
+        fetched = await eutils.fetch_articles(missing, use_proxy=USE_PROXY)
+        if fetched is None:
+            return articles or None
+        ARTICLE_CACHE.put(fetched.values())
+        articles.update(fetched)
+    return articles
+
+
+# Workers of the pipeline stages, see download_all
+FETCH_WORKERS = 4
+PARSE_PROCS = os.cpu_count()
+PARSE_POOL = None
+FIGURE_WORKERS = 4
+# Images downloaded at the same time, by all articles
+FIGURE_DOWNLOADS = 8
+figure_limit = None
+QUEUE_SIZE = pipeline.QUEUE_SIZE
+EXTRACT_PROCS = os.cpu_count()
+EXTRACT_POOL = None
+USE_EXTRACT_CACHE = True
+EXTRACT_CACHE = None
+
+
+def get_figure_limit() -> asyncio.Semaphore:
+    global figure_limit
+    if figure_limit is None:
+        figure_limit = asyncio.Semaphore(FIGURE_DOWNLOADS)
+    return figure_limit
+
+
+async def extract_text(pmid, pdf_path):
     try:
-        resourceManager = PDFResourceManager()
-        strIo = StringIO()
-        device = TextConverter(resourceManager, strIo, laparams=LAParams())
-        interpreter = PDFPageInterpreter(resourceManager, device)
-        with open(pdf_path, 'rb') as f:
-            for page in PDFPage.get_pages(f, set()):
-                interpreter.process_page(page)
-            content = strIo.getvalue()
-        device.close()
-        strIo.close()
         # Write text
         if not os.path.exists(OUTPUT_DIR):
             os.mkdir(OUTPUT_DIR)
@@ -275,8 +312,19 @@ def extract_text(pmid, pdf_path):
         if not os.path.exists(dest_dir):
             os.mkdir(dest_dir)
         filename = os.path.join(dest_dir, f'{pmid}.txt')
-        with open(filename, 'w') as f:
-            f.write(content)
+        key = None
+        if EXTRACT_CACHE is not None:
+            key = await EXTRACT_CACHE.key_of(pdf_path)
+            if EXTRACT_CACHE.get(key, filename):
+                log.debug("Use cached text for pmid %s", pmid)
+                return True
+        if EXTRACT_POOL is not None:
+            await EXTRACT_POOL.extract_to(pdf_path, filename)
+        else:
+            # Off the event loop, which keeps serving the other stages
+            await asyncio.get_running_loop().run_in_executor(None, extract.extract_to, pdf_path, filename)
+        if key is not None:
+            EXTRACT_CACHE.put(key, filename)
     except Exception as e:
         log.warning("Error in extracting text for pmid %s", pdf_path)
         log.warning("%s\n%s", e, traceback.format_exc())
@@ -285,6 +333,7 @@ def extract_text(pmid, pdf_path):
 
 
 def parse_arguments():
+    global PARSE_PROCS, FETCH_WORKERS, FIGURE_WORKERS, FIGURE_DOWNLOADS, QUEUE_SIZE
     parser = arg.ArgumentParser(
         description='Download PDFs from pubmed central by PMIDs')
     parser.add_argument(dest='source', action='store', metavar='PDFs path',
@@ -297,56 +346,153 @@ def parse_arguments():
                         help='Retry the tasks in the failed file')
     parser.add_argument('--use-proxy', dest='use_proxy', action='store_true',
                         help='Use proxy pool to access Pubmed Central')
+    parser.add_argument('--no-progress', dest='no_progress', action='store_true',
+                        help='Do not show download progress')
+    fetch.add_fetch_arguments(parser)
+    parser.add_argument('--offline', '--reparse', dest='offline', action='store_true',
+                        help='Run extractors on cached pages only, without accessing the network')
+    parser.add_argument('--parse-procs', '--reparse-procs', dest='parse_procs', action='store', type=int,
+                        default=os.cpu_count(),
+                        help='Number of processes parsing pages, 0 for parsing in a thread of main process '
+                             '(default: one per core)')
+    parser.add_argument('--fetch-workers', dest='fetch_workers', action='store', type=int,
+                        default=FETCH_WORKERS, help='Number of pages fetched concurrently')
+    parser.add_argument('--figure-workers', dest='figure_workers', action='store', type=int,
+                        default=FIGURE_WORKERS, help='Number of articles downloading figures concurrently')
+    parser.add_argument('--figure-downloads', dest='figure_downloads', action='store', type=int,
+                        default=FIGURE_DOWNLOADS, help='Number of images downloaded concurrently by all articles')
+    parser.add_argument('--image-store', dest='image_store', action='store', metavar='DIR',
+                        help='Directory storing images by content, may be shared by runs (default: OUTPUT_DIR/images/)')
+    parser.add_argument('--queue-size', dest='queue_size', action='store', type=int,
+                        default=QUEUE_SIZE, help='Number of items waiting before each stage')
+    parser.add_argument('--no-mesh', dest='no_mesh', action='store_true',
+                        help='Do not fetch MeSH terms')
+    parser.add_argument('--no-figures', dest='no_figures', action='store_true',
+                        help='Do not download figures')
+    parser.add_argument('--no-pdf', dest='no_pdf', action='store_true',
+                        help='Do not extract text from PDFs')
+    parser.add_argument('--metadata', dest='metadata', action='store', choices=['eutils', 'page'],
+                        default='eutils',
+                        help='Fetch MeSH terms by batched E-utilities requests, or from every PubMed page')
+    parser.add_argument('--eutils-base', dest='eutils_base', action='store', default=eutils.EUTILS_BASE,
+                        help='Base URL of NCBI E-utilities')
+    parser.add_argument('--eutils-batch-size', dest='eutils_batch_size', action='store', type=int,
+                        default=eutils.BATCH_SIZE, help='Number of PMIDs fetched by an E-utilities request')
+    parser.add_argument('--ncbi-api-key', dest='ncbi_api_key', action='store',
+                        help='NCBI API key, allowing a higher request rate')
+    parser.add_argument('--no-consolidate', dest='no_consolidate', action='store_true',
+                        help='Keep results as JSON lines only, without writing mesh.json and graph.json')
+    parser.add_argument('--sqlite', dest='sqlite', action='store', metavar='DB_FILE',
+                        help='Also store results into a SQLite database')
+    parser.add_argument('--extract-procs', dest='extract_procs', action='store', type=int,
+                        default=os.cpu_count(),
+                        help='Number of processes extracting text from PDFs, 0 for extracting in a thread of '
+                             'main process (default: one per core)')
+    parser.add_argument('--extract-timeout', dest='extract_timeout', action='store', type=int,
+                        default=extract.TIMEOUT, help='Timeout in seconds of extracting a PDF in process')
+    parser.add_argument('--extract-memory', dest='extract_memory', action='store', type=int,
+                        default=extract.MEMORY_LIMIT // 1024 // 1024,
+                        help='Memory limit in MiB of an extracting process, 0 for unlimited')
+    parser.add_argument('--extract-shard-pages', dest='extract_shard_pages', action='store', type=int,
+                        default=extract.SHARD_PAGES,
+                        help='Split PDFs longer than this into page ranges extracted in parallel, 0 for never')
+    parser.add_argument('--no-extract-cache', dest='no_extract_cache', action='store_true',
+                        help='Extract text from every PDF again, without the extraction cache')
     # Parse
     args = parser.parse_args()
 
     global USE_PROXY
     USE_PROXY = args.use_proxy
 
+    fetch.configure(args, parser)
+
+    if args.offline:
+        if args.no_http_cache or not os.path.exists(args.http_cache):
+            parser.error('--offline requires pages cached in --http-cache')
+        fetch.OFFLINE = True
+
+    if args.no_progress:
+        fetch.SHOW_PROGRESS = False
+
+    global OPTION_MESH, OPTION_PIC, OPTION_PDF
+    if args.no_mesh and args.no_figures and args.no_pdf:
+        parser.error('--no-mesh, --no-figures and --no-pdf leave nothing to do')
+    OPTION_MESH = not args.no_mesh
+    OPTION_PIC = not args.no_figures
+    OPTION_PDF = not args.no_pdf
+
+    global USE_EUTILS
+    USE_EUTILS = args.metadata == 'eutils'
+    if args.eutils_batch_size < 1:
+        parser.error('--eutils-batch-size must be at least 1')
+    eutils.EUTILS_BASE = args.eutils_base.rstrip('/')
+    eutils.BATCH_SIZE = args.eutils_batch_size
+    eutils.API_KEY = args.ncbi_api_key
+
+    global CONSOLIDATE, SQLITE_PATH
+    CONSOLIDATE = not args.no_consolidate
+    SQLITE_PATH = args.sqlite
+
+    global EXTRACT_PROCS, EXTRACT_POOL
+    if args.extract_procs < 0:
+        parser.error('--extract-procs must not be negative')
+    EXTRACT_PROCS = args.extract_procs
+    if EXTRACT_PROCS > 0:
+        EXTRACT_POOL = extract.ExtractPool(EXTRACT_PROCS, timeout=args.extract_timeout,
+                                           memory_limit=args.extract_memory * 1024 * 1024,
+                                           shard_pages=args.extract_shard_pages)
+
+    global USE_EXTRACT_CACHE
+    USE_EXTRACT_CACHE = not args.no_extract_cache
+
+    global IMAGE_STORE_DIR
+    IMAGE_STORE_DIR = args.image_store
+
+    if args.parse_procs < 0:
+        parser.error('--parse-procs must not be negative')
+    if min(args.fetch_workers, args.figure_workers, args.figure_downloads, args.queue_size) < 1:
+        parser.error('--fetch-workers, --figure-workers, --figure-downloads and --queue-size must be at least 1')
+    PARSE_PROCS = args.parse_procs
+    FETCH_WORKERS = args.fetch_workers
+    FIGURE_WORKERS = args.figure_workers
+    FIGURE_DOWNLOADS = args.figure_downloads
+    QUEUE_SIZE = args.queue_size
+
     if args.output_dir:
         global OUTPUT_DIR
         OUTPUT_DIR = args.output_dir
     return args
 
 
-def load_source_file() -> List[Dict]:
+def load_source_file() -> Iterator[Dict]:
     """
-    Load pmid source from a source file
+    Stream pmid source from a source file
     """
-    # Read
+    if not os.path.isfile(PMID_SOURCE):
+        log.error("Unable to load source file %s!", PMID_SOURCE)
+        quit()
+    # Checked before the lock is created, the file is read while processing
+    return iter_source_file()
+
+
+def iter_source_file():
     try:
-        with open(PMID_SOURCE, 'r') as f:
-            data = json.load(f)
-        return data
+        yield from sources.iter_file(PMID_SOURCE)
     except Exception as e:
         log.error("Unable to load source file %s! %s", PMID_SOURCE, e)
         quit()
 
 
-def load_source_dir() -> List[Dict]:
-    ret = []
-    for root, _, files in os.walk(PMID_SOURCE):
-        for filename in files:
-            path = os.path.join(root, filename)
-
-            if filename[-4:].lower() != '.pdf':
-                continue
-
-            try:
-                pmid = int(filename[:-4])
-                ret.append({
-                    'pmid': pmid,
-                    'path': path
-                })
-            except Exception:
-                log.warning("Error in loading source dir at file %s", path)
-                continue
-    return ret
+def load_source_dir() -> Iterator[Dict]:
+    if not os.path.isdir(PMID_SOURCE):
+        log.error("Unable to load source dir %s!", PMID_SOURCE)
+        quit()
+    return sources.iter_pdf_dir(PMID_SOURCE)
 
 
-def load_source(args) -> List[int]:
+def load_source(args) -> Iterator[Dict]:
     """
-    Load pmid source
+    Load pmid source, items are read while processing
     """
     global PMID_SOURCE
 
@@ -359,30 +505,12 @@ def load_source(args) -> List[int]:
         log.error("No PMIDs or source file given!")
         quit()
 
-    # Load graph cache
-    graph_data = os.path.join(OUTPUT_DIR, 'graph.json')
-    if os.path.exists(graph_data):
-        global FIGURE_RESULT
-        try:
-            with open(graph_data, 'r') as f:
-                FIGURE_RESULT = json.load(f)
-        except Exception:
-            FIGURE_RESULT = []
-    # Load Mesh cache
-    mesh_data = os.path.join(OUTPUT_DIR, 'mesh.json')
-    if os.path.exists(mesh_data):
-        global MESH_RESULT
-        try:
-            with open(mesh_data, 'r') as f:
-                MESH_RESULT = json.load(f)
-        except Exception:
-            MESH_RESULT = []
-
     PMID_SOURCE = args.source
     return load_source_dir()
 
 
-def resume_from_lock(source: List[Dict], resume=False) -> Tuple[int, List[Dict]]:
+def resume_from_lock(resume=False) -> journal.Journal:
+    global JOURNAL
     # Check lock
     if os.path.exists(LOCKFILE):
         if not resume:
@@ -391,41 +519,31 @@ def resume_from_lock(source: List[Dict], resume=False) -> Tuple[int, List[Dict]]
             quit()
         # Resume from lock
         log.info("Lock file exists, try to resume from previous work...")
-        try:
-            with open(LOCKFILE, 'r') as f:
-                lock = json.load(f)
-            if lock['source'] != PMID_SOURCE:
-                raise Exception()
-            if lock['length'] != len(source):
-                raise Exception()
-            failed = []
-            if 'failed' in lock and isinstance(lock['failed'], list):
-                failed = lock['failed']
-            return int(lock['progress']), failed
-        except Exception:
-            log.info("Invalid lock, probably from an old task, ignored.")
+        JOURNAL = journal.Journal.resume(LOCKFILE, PMID_SOURCE)
+        if JOURNAL is not None:
+            return JOURNAL
+        log.info("Invalid lock, probably from an old task, ignored.")
     # Create lock
-    update_lock(source, 0)
+    try:
+        JOURNAL = journal.Journal.create(LOCKFILE, PMID_SOURCE)
+    except Exception as e:
+        log.error("Unable to write lock file! %s", e)
+        quit()
     log.info("Create lock file %s", LOCKFILE)
-    return 0, []
+    return JOURNAL
 
 
-def update_lock(source, progress=0, failed=[]):
-    lock = {
-        'source': PMID_SOURCE,
-        'length': len(source),
-        'progress': progress,
-        'failed': failed
-    }
+def update_lock(idx, item, state):
     try:
-        with open(LOCKFILE, 'w') as f:
-            json.dump(lock, f)
+        JOURNAL.record(idx, item, state)
     except Exception as e:
         log.error("Unable to write lock file! %s", e)
         quit()
 
 
 def clear_lock():
+    if JOURNAL is not None:
+        JOURNAL.close()
     if os.path.exists(LOCKFILE):
         os.unlink(LOCKFILE)
 
@@ -441,38 +559,143 @@ def save_failed(failed):
     log.warning("Using --retry to retry the tasks in the failed file.")
 
 
+def use_page() -> bool:
+    return (OPTION_MESH and not USE_EUTILS) or OPTION_PIC
+
+
+async def fetch_stage(task):
+    if not use_page():
+        return
+    task['html'] = await get_pubmed_html(task['pmid'])
+    if task['html'] is None:
+        task['ok'] = False
+
+
+async def parse_stage(task):
+    html = task.pop('html', None)
+    if html is None:
+        return
+    args = (task['pmid'], html, OPTION_MESH and not USE_EUTILS, OPTION_PIC)
+    # In a thread without the parse pool, off the event loop all the same
+    result = await asyncio.get_running_loop().run_in_executor(PARSE_POOL, parse_html, *args)
+    task['ok'] = task['ok'] and result['ok']
+    task['mesh'] = result['mesh']
+    task['figures'] = result['figures']
+
+
+async def figure_stage(task):
+    if not OPTION_PIC or 'figures' not in task:
+        return
+    figures = task.pop('figures')
+    if figures is None:
+        log.info("No figures for pmid %d", task['pmid'])
+        return
+    task['figures'], ok = await download_figure(task['pmid'], figures)
+    if not ok:
+        task['ok'] = False
+
+
+async def extract_stage(task):
+    if OPTION_PDF and not await extract_text(task['pmid'], task['item']['path']):
+        task['ok'] = False
+
+
+# Items written since the results were flushed. They are recorded into the
+# journal after the flush, so a killed run never skips results it has lost
+FINISHED = []
+
+
+def commit_finished():
+    for sink in (MESH_SINK, FIGURE_SINK, ARTICLE_SINK):
+        if sink is not None:
+            sink.flush()
+    if STORE is not None:
+        STORE.flush()
+    for idx, item, state in FINISHED:
+        update_lock(idx, item, state)
+    FINISHED.clear()
+
+
+async def write_stage(task):
+    pmid = task['pmid']
+    if task.get('article') is not None:
+        save_article(pmid, task['article'])
+    save_result(pmid, {'ok': task['ok'], 'mesh': task.get('mesh'), 'figures': task.get('figures')})
+    FINISHED.append((task['idx'], task['item'], journal.OK if task['ok'] else journal.FAILED))
+    if len(FINISHED) >= store.FLUSH_EVERY:
+        commit_finished()
+
+
+async def produce(source, inbox):
+    """
+    Put unfinished items of source into the pipeline, with their metadata
+
+    Items are fetched in batches of metadata requests, and metadata of the
+    next batch is fetched while the current batch is put.
+    """
+    batches = JOURNAL.unfinished_batches(source, eutils.BATCH_SIZE)
+    batch = next(batches, None)
+    articles = None
+    if batch is not None:
+        articles = asyncio.ensure_future(fetch_articles(batch))
+    while batch is not None:
+        next_batch = next(batches, None)
+        next_articles = None
+        if next_batch is not None:
+            next_articles = asyncio.ensure_future(fetch_articles(next_batch))
+        batch_articles = await articles
+        for idx, item in batch:
+            update_lock(idx, item, journal.PENDING)
+            task = {'idx': idx, 'item': item, 'pmid': item['pmid'], 'ok': True, 'article': None}
+            if OPTION_MESH and USE_EUTILS:
+                task['article'] = batch_articles.get(item['pmid']) if batch_articles is not None else None
+                if task['article'] is None:
+                    log.warning("No metadata from E-utilities for pmid %d", item['pmid'])
+                    task['ok'] = False
+            await inbox.put(task)
+        batch, articles = next_batch, next_articles
+
+
+async def download_all(source):
+    """
+    Process unfinished items of source through a pipeline of stages
+
+    Every stage has its own workers, and bounded queues between stages, so
+    fetching pages, parsing them, downloading figures and extracting text
+    overlap for different items, and the slowest stage sets the pace.
+    """
+    try:
+        await pipeline.run(lambda inbox: produce(source, inbox), [
+            pipeline.Stage('fetch', fetch_stage, FETCH_WORKERS, QUEUE_SIZE),
+            pipeline.Stage('parse', parse_stage, PARSE_PROCS, QUEUE_SIZE),
+            pipeline.Stage('figure', figure_stage, FIGURE_WORKERS, QUEUE_SIZE),
+            pipeline.Stage('extract', extract_stage, EXTRACT_PROCS, QUEUE_SIZE),
+            pipeline.Stage('write', write_stage, 1, QUEUE_SIZE)
+        ])
+    finally:
+        commit_finished()
+    return JOURNAL.failed()
+
+
 if __name__ == "__main__":
     args = parse_arguments()
     # Load PMID soruce
     source = load_source(args)
     # Start downloading
-    total = len(source)
-    start_at, failed = resume_from_lock(source, resume=args.resume)
-    for idx in range(start_at, total):
-        update_lock(source, idx, failed)
-        fail = False
-        pmid = source[idx]['pmid']
-
-        if OPTION_MESH or OPTION_PIC:
-            pubmed_html = get_pubmed_html(pmid)
-            if pubmed_html is None:
-                fail = False
-            else:
-                if OPTION_MESH:
-                    if not download_mesh(pubmed_html):
-                        fail = True
-                
-                if OPTION_PIC:
-                    if not download_figure(pubmed_html):
-                        fail = True
-
-        if OPTION_PDF:
-            if not extract_text(pmid, source[idx]['path']):
-                fail = True
-
-        if fail:
-            failed.append(source[idx])
+    resume_from_lock(resume=args.resume)
+    open_sinks()
+    if PARSE_PROCS > 0:
+        PARSE_POOL = ProcessPoolExecutor(max_workers=PARSE_PROCS)
+    try:
+        failed = fetch.run(download_all(source))
+    finally:
+        close_sinks()
+        if EXTRACT_POOL is not None:
+            EXTRACT_POOL.close()
+        if PARSE_POOL is not None:
+            PARSE_POOL.shutdown()
     # Finish
+    total = JOURNAL.count
     failed_count = len(failed)
     log.info('Completely download %d PDFs, failed %d',
              total - failed_count, failed_count)
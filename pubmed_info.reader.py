@@ -1,167 +1,91 @@
 import os
-import sys
 import json
-import requests
+import shutil
+import asyncio
 import logging as log
 import traceback
-import time
-import string
 import argparse as arg
-from typing import List, Tuple, Dict
-from lxml import etree
-from fake_useragent import UserAgent
-from bs4 import BeautifulSoup
+from typing import Iterator
+from concurrent.futures import ProcessPoolExecutor
+import pubmed_fetch as fetch
+import pubmed_journal as journal
+import pubmed_store as store
+import pubmed_source as sources
+import pubmed_images as images
 
 IMG_BASE = 'https://www.ncbi.nlm.nih.gov'
 USE_PROXY = False
 OUTPUT_DIR = 'reader_info/'
-PROXY_POOL_BASE = 'http://118.24.52.95'
 PMID_SOURCE = ''
 LOCKFILE = 'pubmed_info.reader.lock'
 FAILEDFILE = 'failed.json'
-REQUESTS_PARAM = {
-    'timeout': 30
-}
+JOURNAL = None
+SQLITE_PATH = None
+STORE = None
+REPARSE_PROCS = 0
+REPARSE_POOL = None
+IMAGE_STORE_DIR = None
+IMAGE_STORE = None
+# Articles processed at the same time when online
+WORKERS = 4
+# Images downloaded at the same time, by all articles
+FIGURE_DOWNLOADS = 8
+figure_limit = None
 
 log.basicConfig(level=log.INFO,
                 format='%(asctime)s:%(lineno)d - %(levelname)s: %(message)s')
 
-ua = UserAgent()
-USER_AGENT = ua.random
 
-cur_proxy = None
-fetch_count = 0
+async def get_pmc_reader_html(pmid):
+    url = f'https://www.ncbi.nlm.nih.gov/pmc/articles/pmid/{pmid}/?report=reader'
+    response = await fetch.get_html(url, use_proxy=USE_PROXY)
+    if not response or response.status_code != 200:
+        log.warning("Failed to retrieve data from sever for pmid %d.", pmid)
+        log.warning("This might be a temporary problem. Use argument --retry for a retry.")
+        return None
+    return response.content
 
-def get_proxy(refresh=False):
-    global cur_proxy
-    global fetch_count
-    if cur_proxy is None or refresh or fetch_count > 10:
-        try:
-            cur_proxy = requests.get(f"{PROXY_POOL_BASE}/get/").json().get('proxy')
-            log.info("Renew proxy %s", cur_proxy)
-        except Exception:
-            time.sleep(30)
-            get_proxy(refresh=True)
-        fetch_count = 10
-    fetch_count += 1
-    return cur_proxy
+
+def parse_page(html):
+    """
+    Parse page with lxml, the tree is shared by all extractors of the page
+    """
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, 'lxml')
 
 
-def delete_proxy():
-    requests.get('{}/get/delete/?proxy={}'.format(PROXY_POOL_BASE, cur_proxy))
+def get_figure_limit() -> asyncio.Semaphore:
+    global figure_limit
+    if figure_limit is None:
+        figure_limit = asyncio.Semaphore(FIGURE_DOWNLOADS)
+    return figure_limit
 
 
-def get_html(url, use_proxy=USE_PROXY):
+async def download_image(pmid, fig):
     """
-    Get html from url
+    Download image of a figure into the image store, leaving filepath None if failed
     """
-    retry_count = 5
-    # Proxy config
-    if use_proxy:
-        proxy = get_proxy()
-        proxies = {'http': 'http://{}'.format(proxy)}
-    else:
-        proxies = None
-    # Headers
-    headers = {
-        'User-Agent': USER_AGENT
-    }
-    # Start
-    while retry_count > 0:
-        try:
-            html = requests.get(url, proxies=proxies, headers=headers, **REQUESTS_PARAM)
-            return html
-        except Exception as e:
-            retry_count -= 1
-            log.debug("Probleam in fetching url %s: %s", url, e)
-            # Refresh proxy
-            if use_proxy:
-                proxy = get_proxy(refresh=True)
-                proxies = {'http': 'http://{}'.format(proxy)}
-    # Delete proxy
-    if use_proxy:
-        delete_proxy()
-    log.warning("Fail to get url: %s, maximum retries count exceed.", url)
-    return ''
-
-
-def download(file_path, url, headers=None, proxies=None):
-    # Check file size
-    r1 = requests.get(url, stream=True, headers=headers, proxies=proxies, **REQUESTS_PARAM)
-    total_size = int(r1.headers['Content-Length'])
-    if os.path.exists(file_path):
-        temp_size = os.path.getsize(file_path)  # already downloaded
-    else:
-        temp_size = 0
-    if temp_size >= total_size:
+    url = IMG_BASE + fig['src']
+    # Images named by PMID and figure, saved by older versions
+    legacy_path = os.path.join(OUTPUT_DIR, 'images/', f"{pmid}_{fig['id']}." + fig['src'][-3:])
+
+    async def download(path):
+        if os.path.exists(legacy_path) and not os.path.exists(legacy_path + fetch.VALIDATOR_SUFFIX):
+            shutil.copyfile(legacy_path, path)
+            return True
+        async with get_figure_limit():
+            return await fetch.download_to(url, path, use_proxy=USE_PROXY)
+
+    record = await IMAGE_STORE.fetch(url, download)
+    if record is None:
+        log.warning("Error in downloading figure %s from %s", fig['id'], url)
         return
-    # Continue download
-    headers['Range'] = 'bytes=%d-' % temp_size
-    r = requests.get(url, stream=True, headers=headers, proxies=proxies, **REQUESTS_PARAM)
-    with open(file_path, 'ab') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                temp_size += len(chunk)
-                f.write(chunk)
-                f.flush()
-                done = int(50 * temp_size / total_size)
-                sys.stdout.write('\r[%s%s] %.2f%%' % (
-                    '=' * done, ' ' * (50 - done), 100 * temp_size / total_size))
-                sys.stdout.flush()
-    print()
-
-
-def download_to(url, pmid, filename, path='./', use_proxy=USE_PROXY):
-    if not os.path.exists(OUTPUT_DIR):
-        os.mkdir(OUTPUT_DIR)
-    path = os.path.join(OUTPUT_DIR, path)
-    if not os.path.exists(path):
-        os.mkdir(path)
-    filename = path + filename
-    # Proxy config
-    if use_proxy:
-        proxy = get_proxy()
-        proxies = {'http': 'http://{}'.format(proxy)}
-    else:
-        proxies = None
-    # Headers
-    headers = {
-        'User-Agent': USER_AGENT
-    }
-    # Download
-    retry_count = 5
-    err = None
-    while retry_count > 0:
-        try:
-            download(filename, url, headers=headers, proxies=proxies)
-            return filename
-        except Exception as e:
-            err = e
-            retry_count -= 1
-            # Refresh proxy
-            if use_proxy:
-                proxy = get_proxy(refresh=True)
-                proxies = {'http': 'http://{}'.format(proxy)}
-    if use_proxy:
-        delete_proxy()
-    log.warning("Fail to download file: %s, maximum retries count exceed.", url)
-    log.warning("%s\n%s", err, traceback.format_exc())
-    return False
-
-
-def get_pmc_reader_html(pmid):
-    url = f'https://www.ncbi.nlm.nih.gov/pmc/articles/pmid/{pmid}/?report=reader'
-    response = get_html(url, use_proxy=USE_PROXY)
-    if not response or response.status_code != requests.codes['\\o/']:
-        log.warning("Failed to retrieve data from sever for pmid %d.", pmid)
-        log.warning("This might be a temporary problem. Use argument --retry for a retry.")
-        return None
-    return response.content
+    fig['sha256'] = record['sha256']
+    fig['filepath'] = os.path.relpath(IMAGE_STORE.path_of(record['sha256'], record['ext']), OUTPUT_DIR)
 
 
-def dowload_figure(pmid, html):
+async def dowload_figure(pmid, soup):
     figs = []
-    soup = BeautifulSoup(html, 'html.parser')
     el_figs = soup.select('.fig.iconblock')
     for el_fig in el_figs:
         # get id
@@ -181,19 +105,19 @@ def dowload_figure(pmid, html):
         name = el_name.get_text()
         el_name.extract()
         caption = el_desc.get_text().replace('\n', ' ')
-        # download image
-        url = IMG_BASE + src
-        path = 'images/'
-        filename = f"{pmid}_{id}." + src[-3:]
-        download_to(url, pmid, filename, path)
-        # save
         figs.append({
             'id': id,
             'name': name,
             'caption': caption,
             'src': src,
-            'filepath': path + filename
+            'filepath': None
         })
+    # Download images concurrently, under the global FIGURE_DOWNLOADS limit.
+    # Figures are kept even if their images failed, as paragraphs refer to them
+    results = await asyncio.gather(*[download_image(pmid, fig) for fig in figs], return_exceptions=True)
+    for fig, result in zip(figs, results):
+        if isinstance(result, Exception):
+            log.warning("Error in downloading figure %s of pmid %d: %s", fig['id'], pmid, result)
     return figs
 
 
@@ -217,8 +141,7 @@ def deal_with_para(el_para):
         'figs': figs
     }
 
-def parse_content(html):
-    soup = BeautifulSoup(html, 'html.parser')
+def parse_content(soup):
     el_title = soup.find(class_="content-title")
     title = el_title.get_text() if el_title is not None else "<unk>"
     title = title.replace('\n', ' ')
@@ -294,18 +217,23 @@ def parse_content(html):
     }
 
 
-def download_info(pmid):
+async def fetch_info(pmid):
     # Search for figure
-    html = get_pmc_reader_html(pmid)
+    html = await get_pmc_reader_html(pmid)
     try:
-        imgs = dowload_figure(pmid, html)
-        data = parse_content(html)
+        # Figures first, since parse_content modifies the tree
+        soup = parse_page(html)
+        imgs = await dowload_figure(pmid, soup)
+        data = parse_content(soup)
         data['images'] = imgs
     except Exception as e:
         log.warning("Error in downloading info for pmid %d", pmid)
         log.warning("%s\n%s", e, traceback.format_exc())
-        return False
-    # Save
+        return None
+    return data
+
+
+def save_info(pmid, data):
     try:
         if not os.path.exists(OUTPUT_DIR):
             os.mkdir(OUTPUT_DIR)
@@ -315,34 +243,92 @@ def download_info(pmid):
         filename = f"{path}{pmid}.json"
         with open(filename, 'w') as f:
             json.dump(data, f)
+        if STORE is not None:
+            STORE.write_content(pmid, data)
     except Exception as e:
         log.error(f"Unable to write result for pmid %d! %s", pmid, e)
         return False
     return True
 
 
-def load_source_file() -> List[int]:
+def all_images(data) -> bool:
+    missing = [img['id'] for img in data['images'] if img['filepath'] is None]
+    if missing:
+        log.warning("Missing images %s, use --retry to download them", ', '.join(missing))
+    return not missing
+
+
+async def download_info(pmid):
+    data = await fetch_info(pmid)
+    if data is None:
+        return False
+    return save_info(pmid, data) and all_images(data)
+
+
+def open_image_store():
+    global IMAGE_STORE
+    image_dir = IMAGE_STORE_DIR or os.path.join(OUTPUT_DIR, 'images/')
+    IMAGE_STORE = images.ImageStore(image_dir, os.path.join(image_dir, 'index.jsonl'))
+
+
+def init_reparse_worker(output_dir, image_dir, cache_path):
+    global OUTPUT_DIR, IMAGE_STORE_DIR
+    OUTPUT_DIR = output_dir
+    IMAGE_STORE_DIR = image_dir
+    open_image_store()
+    fetch.OFFLINE = True
+    fetch.CACHE_PATH = cache_path
+    # Never share the connection inherited from the parent process
+    fetch.cache = None
+    fetch.open_cache(readonly=True)
+
+
+def reparse_info(pmid):
     """
-    Load pmid source from a source file
+    Parse the cached page, in a reparse worker process
     """
-    # Read
+    return asyncio.run(fetch_info(pmid))
+
+
+async def reparse_in_pool(pmid):
+    loop = asyncio.get_running_loop()
     try:
-        with open(PMID_SOURCE, 'r') as f:
-            data = json.load(f)
+        data = await loop.run_in_executor(REPARSE_POOL, reparse_info, pmid)
     except Exception as e:
-        log.error("Unable to load source file %s! %s", PMID_SOURCE, e)
+        log.warning("Error in reparsing pmid %d", pmid)
+        log.warning("%s\n%s", e, traceback.format_exc())
+        return False
+    if data is None:
+        return False
+    return save_info(pmid, data) and all_images(data)
+
+
+def load_source_file() -> Iterator[int]:
+    """
+    Stream pmid source from a source file
+
+    The file is a JSON array or JSON lines of objects with `pmid`, or a text
+    file with one PMID per line.
+    """
+    if not os.path.isfile(PMID_SOURCE):
+        log.error("Unable to load source file %s!", PMID_SOURCE)
         quit()
-    # Parse
+    # Checked before the lock is created, the file is read while downloading
+    return iter_source_file()
+
+
+def iter_source_file():
     try:
-        return [x['pmid'] for x in data]
-    except Exception:
-        log.error("Data source format invalid!")
+        for item in sources.iter_file(PMID_SOURCE):
+            yield int(item['pmid'] if isinstance(item, dict) else item)
+    except Exception as e:
+        log.error("Unable to load source file %s! %s", PMID_SOURCE, e)
         quit()
 
 
-def load_source(args) -> List[int]:
+def load_source(args) -> Iterator[int]:
     """
-    Load pmid source
+    Load pmid source, items are read while downloading
     """
     global PMID_SOURCE
 
@@ -366,6 +352,7 @@ def load_source(args) -> List[int]:
 
 
 def parse_arguments():
+    global WORKERS, FIGURE_DOWNLOADS
     parser = arg.ArgumentParser(
         description='Download info from pubmed central by PMIDs')
     parser.add_argument(dest='source', metavar='PMIDs or PMID source file',
@@ -378,19 +365,58 @@ def parse_arguments():
                         help='Retry the tasks in the failed file')
     parser.add_argument('--use-proxy', dest='use_proxy', action='store_true',
                         help='Use proxy pool to access Pubmed Central')
+    parser.add_argument('--no-progress', dest='no_progress', action='store_true',
+                        help='Do not show download progress')
+    parser.add_argument('--workers', dest='workers', action='store', type=int, default=WORKERS,
+                        help='Number of articles downloaded concurrently')
+    parser.add_argument('--figure-downloads', dest='figure_downloads', action='store', type=int,
+                        default=FIGURE_DOWNLOADS, help='Number of images downloaded concurrently by all articles')
+    fetch.add_fetch_arguments(parser)
+    parser.add_argument('--offline', '--reparse', dest='offline', action='store_true',
+                        help='Parse cached pages only, without accessing the network')
+    parser.add_argument('--reparse-procs', dest='reparse_procs', action='store', type=int,
+                        default=os.cpu_count(), help='Number of processes parsing cached pages offline')
+    parser.add_argument('--image-store', dest='image_store', action='store', metavar='DIR',
+                        help='Directory storing images by content, may be shared by runs (default: OUTPUT_DIR/images/)')
+    parser.add_argument('--sqlite', dest='sqlite', action='store', metavar='DB_FILE',
+                        help='Also store results into a SQLite database')
     # Parse
     args = parser.parse_args()
 
     global USE_PROXY
     USE_PROXY = args.use_proxy
 
+    fetch.configure(args, parser)
+
+    global REPARSE_PROCS
+    if args.offline:
+        if args.no_http_cache or not os.path.exists(args.http_cache):
+            parser.error('--offline requires pages cached in --http-cache')
+        if args.reparse_procs < 1:
+            parser.error('--reparse-procs must be at least 1')
+        fetch.OFFLINE = True
+        REPARSE_PROCS = args.reparse_procs
+
+    if args.no_progress:
+        fetch.SHOW_PROGRESS = False
+
+    if args.workers < 1 or args.figure_downloads < 1:
+        parser.error('--workers and --figure-downloads must be at least 1')
+    WORKERS = args.workers
+    FIGURE_DOWNLOADS = args.figure_downloads
+
+    global SQLITE_PATH, IMAGE_STORE_DIR
+    SQLITE_PATH = args.sqlite
+    IMAGE_STORE_DIR = args.image_store
+
     if args.output_dir:
         global OUTPUT_DIR
         OUTPUT_DIR = args.output_dir
     return args
 
 
-def resume_from_lock(source: List[int], resume=False) -> Tuple[int, List[int]]:
+def resume_from_lock(resume=False) -> journal.Journal:
+    global JOURNAL
     # Check lock
     if os.path.exists(LOCKFILE):
         if not resume:
@@ -399,41 +425,31 @@ def resume_from_lock(source: List[int], resume=False) -> Tuple[int, List[int]]:
             quit()
         # Resume from lock
         log.info("Lock file exists, try to resume from previous work...")
-        try:
-            with open(LOCKFILE, 'r') as f:
-                lock = json.load(f)
-            if lock['source'] != PMID_SOURCE:
-                raise Exception()
-            if lock['length'] != len(source):
-                raise Exception()
-            failed = []
-            if 'failed' in lock and isinstance(lock['failed'], list):
-                failed = [int(x) for x in lock['failed']]
-            return int(lock['progress']), failed
-        except Exception:
-            log.info("Invalid lock, probably from an old task, ignored.")
+        JOURNAL = journal.Journal.resume(LOCKFILE, PMID_SOURCE)
+        if JOURNAL is not None:
+            return JOURNAL
+        log.info("Invalid lock, probably from an old task, ignored.")
     # Create lock
-    update_lock(source, 0)
+    try:
+        JOURNAL = journal.Journal.create(LOCKFILE, PMID_SOURCE)
+    except Exception as e:
+        log.error("Unable to write lock file! %s", e)
+        quit()
     log.info("Create lock file %s", LOCKFILE)
-    return 0, []
+    return JOURNAL
 
 
-def update_lock(source, progress=0, failed=[]):
-    lock = {
-        'source': PMID_SOURCE,
-        'length': len(source),
-        'progress': progress,
-        'failed': failed
-    }
+def update_lock(idx, item, state):
     try:
-        with open(LOCKFILE, 'w') as f:
-            json.dump(lock, f)
+        JOURNAL.record(idx, item, state)
     except Exception as e:
         log.error("Unable to write lock file! %s", e)
         quit()
 
 
 def clear_lock():
+    if JOURNAL is not None:
+        JOURNAL.close()
     if os.path.exists(LOCKFILE):
         os.unlink(LOCKFILE)
 
@@ -450,20 +466,79 @@ def save_failed(failed):
     log.warning("Using --retry to retry the tasks in the failed file.")
 
 
+# Items written since the database was committed. They are recorded into the
+# journal after the commit, so a killed run never skips results it has lost
+FINISHED = []
+
+
+def commit_finished():
+    if STORE is not None:
+        STORE.flush()
+    for idx, pmid, state in FINISHED:
+        update_lock(idx, pmid, state)
+    FINISHED.clear()
+
+
+async def download_item(idx, pmid):
+    update_lock(idx, pmid, journal.PENDING)
+    if REPARSE_POOL is not None:
+        ok = await reparse_in_pool(pmid)
+    else:
+        ok = await download_info(pmid)
+    FINISHED.append((idx, pmid, journal.OK if ok else journal.FAILED))
+    # Content files are complete once written, only the database is flushed later
+    if STORE is None or len(FINISHED) >= store.FLUSH_EVERY:
+        commit_finished()
+
+
+async def download_all(source):
+    """
+    Process unfinished items of source, keeping every reparse process busy
+    """
+    workers = REPARSE_PROCS if REPARSE_POOL is not None else WORKERS
+    pending = set()
+    try:
+        for idx, pmid in JOURNAL.unfinished(source):
+            if len(pending) >= workers:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.add(asyncio.ensure_future(download_item(idx, pmid)))
+        if pending:
+            await asyncio.wait(pending)
+    finally:
+        commit_finished()
+    return JOURNAL.failed()
+
+
 if __name__ == "__main__":
     args = parse_arguments()
     # Load PMID soruce
     source = load_source(args)
     # Start downloading
-    total = len(source)
-    start_at, failed = resume_from_lock(source, resume=args.resume)
-    for idx in range(start_at, total):
-        update_lock(source, idx, failed)
-        if download_info(source[idx]):
-            pass
-        else:
-            failed.append(source[idx])
+    resume_from_lock(resume=args.resume)
+    if SQLITE_PATH:
+        try:
+            STORE = store.SqliteStore(SQLITE_PATH)
+        except Exception as e:
+            log.error("Unable to open database %s! %s", SQLITE_PATH, e)
+            quit()
+    try:
+        open_image_store()
+    except Exception as e:
+        log.error("Unable to open image store! %s", e)
+        quit()
+    if REPARSE_PROCS > 0:
+        REPARSE_POOL = ProcessPoolExecutor(max_workers=REPARSE_PROCS, initializer=init_reparse_worker,
+                                           initargs=(OUTPUT_DIR, IMAGE_STORE_DIR, fetch.CACHE_PATH))
+    try:
+        failed = fetch.run(download_all(source))
+    finally:
+        if STORE is not None:
+            STORE.close()
+        IMAGE_STORE.close()
+        if REPARSE_POOL is not None:
+            REPARSE_POOL.shutdown()
     # Finish
+    total = JOURNAL.count
     failed_count = len(failed)
     log.info('Completely download %d PDFs, failed %d',
              total - failed_count, failed_count)
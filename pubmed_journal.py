@@ -0,0 +1,183 @@
+import os
+import json
+import hashlib
+import logging as log
+from typing import List
+
+PENDING = 'pending'
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+FINISHED_STATES = (OK, FAILED, SKIPPED)
+
+COMPACT_EVERY = 1000
+# Bytes at the head of a source file hashed into its fingerprint
+FINGERPRINT_SIZE = 64 * 1024
+
+
+def fingerprint(source):
+    """
+    Size and hash of the head of a source file, None if source is not a file
+
+    Items are resumed by index, so a source file regenerated under the same
+    name must not be resumed.
+    """
+    if not os.path.isfile(source):
+        return None
+    with open(source, 'rb') as f:
+        head = f.read(FINGERPRINT_SIZE)
+    return '{}:{}'.format(os.path.getsize(source), hashlib.sha256(head).hexdigest())
+
+
+class Journal:
+    """
+    Append-only progress journal of a task, stored as JSON lines
+
+    The first line is the header with the source and the fingerprint of its
+    file. The source may be streamed, so its length is not known. Every later
+    line records the state of the item at `idx`, so tasks finishing out of
+    order are described exactly. A line with `progress` states that every
+    item before it has finished. The journal is compacted every COMPACT_EVERY
+    records into the header, the progress line and the records not covered
+    by it. The header counts the states of records dropped by compaction.
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        self.fingerprint = fingerprint(source)
+        # Number of items iterated by unfinished()
+        self.count = 0
+        self.progress = 0
+        self.states = {}  # idx -> (state, item), for idx >= progress or failed
+        self.legacy_failed = []
+        self.compacted = {}  # state -> number of records dropped by compaction
+        self.appended = 0
+        self.file = None
+
+    @classmethod
+    def create(cls, path, source) -> 'Journal':
+        journal = cls(path, source)
+        journal.compact()
+        return journal
+
+    @classmethod
+    def resume(cls, path, source) -> 'Journal':
+        """
+        Replay the journal at path, None if it belongs to another task
+        """
+        journal = cls(path, source)
+        try:
+            with open(path, 'r') as f:
+                header = json.loads(f.readline())
+                # Journals of old versions also have the length of the source,
+                # but no fingerprint
+                if header['source'] != source:
+                    return None
+                if header.get('fingerprint', journal.fingerprint) != journal.fingerprint:
+                    log.warning("Source %s has changed since the journal was written", source)
+                    return None
+                # Lock file of old versions is a single JSON object with
+                # progress and failed items without indexes
+                journal.progress = int(header.get('progress', 0))
+                journal.legacy_failed = list(header.get('failed', []))
+                journal.compacted = dict(header.get('compacted', {}))
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write when crashed
+                        continue
+                    journal.replay(record)
+        except Exception as e:
+            log.debug("Unable to replay journal %s: %s", path, e)
+            return None
+        journal.compact()
+        return journal
+
+    def replay(self, record):
+        if 'progress' in record:
+            self.progress = max(self.progress, int(record['progress']))
+        elif 'idx' in record:
+            self.states[int(record['idx'])] = (record['state'], record.get('item'))
+
+    def is_finished(self, idx) -> bool:
+        if idx < self.progress:
+            return True
+        state = self.states.get(idx)
+        return state is not None and state[0] in FINISHED_STATES
+
+    def unfinished(self, items):
+        """
+        Iterate (idx, item) of unfinished items, counting all items
+        """
+        self.count = 0
+        for idx, item in enumerate(items):
+            self.count = idx + 1
+            if not self.is_finished(idx):
+                yield idx, item
+
+    def unfinished_batches(self, items, size):
+        """
+        Iterate unfinished (idx, item) in batches of at most size
+        """
+        batch = []
+        for entry in self.unfinished(items):
+            batch.append(entry)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def record(self, idx, item, state):
+        self.states[idx] = (state, item)
+        self.file.write(json.dumps({'idx': idx, 'item': item, 'state': state}) + '\n')
+        self.file.flush()
+        self.appended += 1
+        if self.appended >= COMPACT_EVERY:
+            self.compact()
+
+    def count_state(self, state) -> int:
+        """
+        Number of items recorded in state, including those compacted
+        """
+        return self.compacted.get(state, 0) + sum(1 for s, _ in self.states.values() if s == state)
+
+    def failed(self) -> List:
+        failed = [item for _, (state, item) in sorted(self.states.items()) if state == FAILED]
+        return self.legacy_failed + failed
+
+    def compact(self):
+        """
+        Rewrite the journal atomically with the progress and remaining records
+        """
+        while self.is_finished(self.progress):
+            state = self.states[self.progress][0]
+            if state != FAILED:
+                self.compacted[state] = self.compacted.get(state, 0) + 1
+                del self.states[self.progress]
+            self.progress += 1
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            header = {'source': self.source, 'fingerprint': self.fingerprint}
+            if self.legacy_failed:
+                header['failed'] = self.legacy_failed
+            if self.compacted:
+                header['compacted'] = self.compacted
+            f.write(json.dumps(header) + '\n')
+            f.write(json.dumps({'progress': self.progress}) + '\n')
+            for idx, (state, item) in sorted(self.states.items()):
+                f.write(json.dumps({'idx': idx, 'item': item, 'state': state}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if self.file is not None:
+            self.file.close()
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'a')
+        self.appended = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import asyncio
+import logging as log
+from email.utils import parsedate_to_datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Lowest adaptive rate of a host, in requests per second
+MIN_RATE = 0.2
+# Responses asking us to slow down
+THROTTLE_STATUS = (429, 503)
+# Pause of a throttled host without Retry-After, in seconds
+THROTTLE_PAUSE = 10
+# Successful responses in a row before speeding up again
+INCREASE_EVERY = 50
+# State of a shared bucket untouched for this long is left by an earlier run
+STATE_TTL = 300
+
+
+class RateLimited(Exception):
+
+    def __init__(self, url, status, retry_after=None):
+        super().__init__(f"Rate limited ({status}) by {url}")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    Parse `Retry-After` header into seconds, None if absent or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class TokenBucket:
+    """
+    Token bucket of a host within this process
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Take a token, return seconds to wait before it is really available
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def set_rate(self, rate):
+        self.rate = rate
+
+    def get_rate(self):
+        return self.rate
+
+
+class SharedTokenBucket:
+    """
+    Token bucket of a host shared by processes, stored in a locked file
+
+    The rate adapted by running processes is kept, but never beyond the rate
+    of this process, and a state left by an earlier run starts over.
+    """
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.update(self.open_state)
+
+    def open_state(self, state):
+        if time.time() - state['updated'] > STATE_TTL:
+            state.update(tokens=self.burst, updated=time.time(), rate=self.rate)
+        state['rate'] = min(state['rate'], self.rate)
+
+    def update(self, func):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            raw = os.read(self.fd, 4096)
+            try:
+                state = json.loads(raw)
+            except ValueError:
+                state = {'tokens': self.burst, 'updated': time.time(), 'rate': self.rate}
+            result = func(state)
+            data = json.dumps(state).encode()
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, data)
+            return result
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def take(self) -> float:
+        def take(state):
+            now = time.time()
+            rate = state['rate']
+            state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * rate)
+            state['updated'] = now
+            state['tokens'] -= 1
+            return 0.0 if state['tokens'] >= 0 else -state['tokens'] / rate
+        return self.update(take)
+
+    def set_rate(self, rate):
+        self.update(lambda state: state.update(rate=rate))
+
+    def get_rate(self):
+        return self.update(lambda state: state['rate'])
+
+
+class HostLimiter:
+    """
+    Rate and concurrency limit of a host, adapting to throttling responses
+
+    Requests take tokens from a bucket refilled at `rate` per second. When the
+    host answers 429 or 503, the host is paused for Retry-After, the rate and
+    the concurrency are halved, once for all responses throttled during the
+    pause. They grow back slowly while requests succeed, up to the configured
+    rate and concurrency.
+    """
+
+    def __init__(self, host, rate, concurrency, state_dir=None):
+        self.host = host
+        self.max_rate = rate
+        self.max_concurrency = concurrency
+        self.concurrency = concurrency
+        self.active = 0
+        self.cond = None
+        self.paused_until = 0.0
+        self.successes = 0
+        if state_dir and fcntl is not None:
+            os.makedirs(state_dir, exist_ok=True)
+            path = os.path.join(state_dir, host.replace(':', '_') + '.bucket')
+            self.bucket = SharedTokenBucket(path, rate, max(1.0, rate))
+        else:
+            self.bucket = TokenBucket(rate, max(1.0, rate))
+
+    async def acquire(self):
+        if self.cond is None:
+            self.cond = asyncio.Condition()
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.active < self.concurrency)
+            self.active += 1
+        try:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            wait = self.bucket.take()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        except BaseException:
+            # Cancelled before the request, which would release the slot
+            self.active -= 1
+            asyncio.ensure_future(self.wake())
+            raise
+
+    async def release(self):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def feedback(self, status, retry_after=None):
+        if status in THROTTLE_STATUS:
+            pause = parse_retry_after(retry_after)
+            if pause is None:
+                pause = THROTTLE_PAUSE
+            now = time.monotonic()
+            # Responses in flight when throttled come back throttled as well,
+            # the limits are halved once for them all
+            if now < self.paused_until:
+                self.paused_until = max(self.paused_until, now + pause)
+                self.successes = 0
+                return
+            self.paused_until = now + pause
+            rate = max(MIN_RATE, self.bucket.get_rate() / 2)
+            self.bucket.set_rate(rate)
+            self.concurrency = max(1, self.concurrency // 2)
+            self.successes = 0
+            log.warning("Throttled by %s (%d), slow down to %.2f req/s, %d concurrent, pause %.1fs",
+                        self.host, status, rate, self.concurrency, pause)
+            return
+        self.successes += 1
+        if self.successes >= INCREASE_EVERY:
+            self.successes = 0
+            self.bucket.set_rate(min(self.max_rate, self.bucket.get_rate() * 1.1))
+            if self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                if self.cond is not None:
+                    asyncio.ensure_future(self.wake())
+
+    async def wake(self):
+        async with self.cond:
+            self.cond.notify_all()
@@ -0,0 +1,64 @@
+import asyncio
+import logging as log
+import traceback
+
+QUEUE_SIZE = 32
+
+
+class Stage:
+    """
+    Stage of a pipeline, running `func(task)` by `workers` concurrent workers
+
+    Tasks wait in a bounded queue before the stage, so a slow stage holds back
+    the stages before it instead of piling up tasks in memory. A task failed in
+    a stage is marked as not ok and still passed on, so that it is recorded.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=QUEUE_SIZE):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.inbox = asyncio.Queue(queue_size)
+
+    async def worker(self, outbox):
+        while True:
+            task = await self.inbox.get()
+            if task is None:
+                # Let the other workers of the stage stop as well
+                await self.inbox.put(None)
+                return
+            try:
+                await self.func(task)
+            except Exception as e:
+                log.warning("Error in stage %s for %s", self.name, task.get('pmid'))
+                log.warning("%s\n%s", e, traceback.format_exc())
+                task['ok'] = False
+            if outbox is not None:
+                await outbox.put(task)
+
+    async def run(self, outbox):
+        await asyncio.gather(*[self.worker(outbox) for _ in range(self.workers)])
+        if outbox is not None:
+            await outbox.put(None)
+
+
+async def run(produce, stages):
+    """
+    Run stages connected in order, fed by the coroutine function produce
+
+    `produce(inbox)` puts tasks into the queue of the first stage, and returns
+    when all tasks are put.
+    """
+    async def feed():
+        await produce(stages[0].inbox)
+        await stages[0].inbox.put(None)
+
+    runners = [asyncio.ensure_future(feed())]
+    for stage, next_stage in zip(stages, stages[1:] + [None]):
+        runners.append(asyncio.ensure_future(stage.run(next_stage.inbox if next_stage else None)))
+    try:
+        await asyncio.gather(*runners)
+    finally:
+        # Stop the others if a stage failed
+        for runner in runners:
+            runner.cancel()
@@ -0,0 +1,164 @@
+import asyncio
+import logging as log
+
+# Proxies kept ready in the pool
+POOL_SIZE = 8
+# Requests sent through a proxy at the same time
+CONCURRENCY = 2
+# Smoothing factor of latency and error rate
+EWMA_ALPHA = 0.3
+# A proxy is evicted when its error rate exceeds this after MIN_REQUESTS
+MAX_ERROR_RATE = 0.5
+MIN_REQUESTS = 3
+# Seconds added to the score at full error rate, as a failure often costs a
+# connect timeout and gives no latency to score by
+ERROR_PENALTY = 10
+# Pause before asking the pool service again when it fails, in seconds
+REFILL_PAUSE = 5
+
+
+class Proxy:
+
+    def __init__(self, address):
+        self.address = address
+        self.url = 'http://{}'.format(address)
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.active = 0
+        self.evicted = False
+
+    def score(self) -> float:
+        """
+        Lower is better, unknown proxies are tried first
+        """
+        latency = self.latency if self.latency is not None else 0.0
+        return latency * (1 + 4 * self.error_rate) + ERROR_PENALTY * self.error_rate + self.active
+
+    def healthy(self) -> bool:
+        return self.requests < MIN_REQUESTS or self.error_rate <= MAX_ERROR_RATE
+
+    def observe(self, ok):
+        self.requests += 1
+        self.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+
+    def observe_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+
+
+class ProxyPool:
+    """
+    Local pool of proxies from the proxy pool service
+
+    Proxies are prefetched up to `size` in the background. Each request gets
+    the proxy with the best score among those with a free slot, scored by the
+    latency and error rate observed so far. A proxy is used by at most
+    `concurrency` requests at a time. Unhealthy proxies are evicted, and their
+    deletion is reported to the service in the background.
+    """
+
+    def __init__(self, base, session_factory, size=POOL_SIZE, concurrency=CONCURRENCY):
+        self.base = base
+        self.session_factory = session_factory
+        self.size = size
+        self.concurrency = concurrency
+        self.proxies = {}  # url -> Proxy
+        self.cond = None
+        self.refill_task = None
+        self.tasks = set()
+
+    def start(self):
+        if self.cond is None:
+            self.cond = asyncio.Condition()
+        if self.refill_task is None or self.refill_task.done():
+            self.refill_task = asyncio.ensure_future(self.refill())
+
+    async def fetch_proxy(self):
+        async with self.session_factory().get(f"{self.base}/get/") as r:
+            return (await r.json(content_type=None)).get('proxy')
+
+    async def refill(self):
+        while len(self.proxies) < self.size:
+            try:
+                address = await self.fetch_proxy()
+            except Exception as e:
+                log.debug("Unable to get proxy from %s: %s", self.base, e)
+                await asyncio.sleep(REFILL_PAUSE)
+                continue
+            if not address:
+                await asyncio.sleep(REFILL_PAUSE)
+                continue
+            proxy = Proxy(address)
+            if proxy.url in self.proxies:
+                # The service has fewer proxies than the pool size
+                await asyncio.sleep(REFILL_PAUSE)
+                continue
+            log.info("Add proxy %s", address)
+            self.proxies[proxy.url] = proxy
+            async with self.cond:
+                self.cond.notify_all()
+
+    def pick(self, exclude=()):
+        candidates = [proxy for proxy in self.proxies.values() if proxy.active < self.concurrency]
+        if any(url not in exclude for url in self.proxies):
+            candidates = [proxy for proxy in candidates if proxy.url not in exclude]
+        if not candidates:
+            return None
+        return min(candidates, key=Proxy.score)
+
+    async def acquire(self, exclude=()) -> Proxy:
+        """
+        Wait for a proxy with a free slot, and take the slot
+
+        Proxies with url in exclude are only taken if the pool has no other.
+        """
+        self.start()
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.pick(exclude) is not None)
+            proxy = self.pick(exclude)
+            proxy.active += 1
+            return proxy
+
+    async def release(self, proxy, ok):
+        proxy.active -= 1
+        proxy.observe(ok)
+        if not proxy.healthy():
+            self.evict(proxy)
+        async with self.cond:
+            self.cond.notify_all()
+
+    def observe_latency(self, url, latency):
+        """
+        Record the time to response headers of a request through proxy url
+        """
+        proxy = self.proxies.get(url)
+        if proxy is not None:
+            proxy.observe_latency(latency)
+
+    def evict(self, proxy):
+        if proxy.evicted:
+            return
+        proxy.evicted = True
+        self.proxies.pop(proxy.url, None)
+        log.info("Evict proxy %s, error rate %.2f", proxy.address, proxy.error_rate)
+        task = asyncio.ensure_future(self.delete_proxy(proxy.address))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.start()
+
+    async def delete_proxy(self, address):
+        try:
+            async with self.session_factory().get(f"{self.base}/get/delete/?proxy={address}"):
+                pass
+        except Exception as e:
+            log.debug("Unable to delete proxy %s: %s", address, e)
+
+    async def close(self):
+        if self.refill_task is not None:
+            self.refill_task.cancel()
+            self.refill_task = None
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
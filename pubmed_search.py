@@ -1,52 +1,145 @@
-from pymed import PubMed
-import json
+import os
+import asyncio
+import datetime
+import logging as log
+import argparse as arg
+import pubmed_fetch as fetch
+import pubmed_eutils as eutils
+import pubmed_store as store
 
-pubmed = PubMed(tool="PubmedToolkit", email="admin@kaaass.net")
+log.basicConfig(level=log.INFO,
+                format='%(asctime)s:%(lineno)d - %(levelname)s: %(message)s')
 
 start = '2013/01/01'
 end = '2017/01/01'
 query = '(("english"[Language]) AND "case reports"[Publication Type]) ' \
-    + f'AND ("{start}"[Date - Publication] : "{end}"[Date - Publication]) ' \
     + 'AND ("humans"[MeSH Terms]) AND ("Case Reports"[ptyp]) AND ("English"[lang]) ' \
-    + 'AND ("pubmed pmc local"[sb]))'
-
-results = pubmed.query(query, max_results=5000)
-
-count = 0
-
-def save(force=False, every=100):
-    global count
-    if not force:
-        count += 1
-        if count >= every:
-            count = 0
-        else:
-            return
-    print('Save data, fetched', len(data))
-    with open('data.json', 'w') as f:
-        json.dump(data, f)
-
-data = []
-
-for article in results:
-    pmid = int(article.pubmed_id.split('\n')[0])
-    title = article.title
-    keywords = []
-    if article.keywords:
-        if None in article.keywords:
-            article.keywords.remove(None)
-        keywords = article.keywords
-    publication_date = article.publication_date
-    abstract = article.abstract
-
-    data.append({
+    + 'AND ("pubmed pmc local"[sb])'
+
+# ESearch returns at most this many PMIDs of a query, so the publication date
+# range is split into shards with fewer results
+SHARD_LIMIT = 9999
+# Shards searched concurrently, requests are rate limited by pubmed_fetch
+SHARDS = 4
+
+DATE_FORMAT = '%Y/%m/%d'
+
+OUTPUT = 'data.jsonl'
+CONSOLIDATED = 'data.json'
+
+
+def shard_query(first, last):
+    return f'({query}) AND ("{first:{DATE_FORMAT}}"[Date - Publication] : ' \
+        + f'"{last:{DATE_FORMAT}}"[Date - Publication])'
+
+
+async def split_range(first, last):
+    """
+    Split the date range into shards of at most SHARD_LIMIT results
+    """
+    count = await eutils.count(shard_query(first, last))
+    if count is None:
+        raise Exception(f"Unable to count results from {first} to {last}")
+    if count == 0:
+        return []
+    if count <= SHARD_LIMIT or first == last:
+        if count > SHARD_LIMIT:
+            log.warning("%d results on %s, only the first %d are fetched", count, first, SHARD_LIMIT)
+        return [(first, last, count)]
+    mid = first + (last - first) // 2
+    halves = await asyncio.gather(split_range(first, mid),
+                                  split_range(mid + datetime.timedelta(days=1), last))
+    return halves[0] + halves[1]
+
+
+async def search_shard(shard, on_article) -> bool:
+    """
+    Fetch articles of a shard, handing each batch over as it arrives
+    """
+    first, last, _ = shard
+    pmids = await eutils.search_ids(shard_query(first, last), SHARD_LIMIT)
+    if pmids is None:
+        return False
+    # Articles written by a previous run are not fetched again
+    pmids = [pmid for pmid in pmids if pmid not in seen]
+    ok = True
+    for idx in range(0, len(pmids), eutils.BATCH_SIZE):
+        articles = await eutils.fetch_articles(pmids[idx:idx + eutils.BATCH_SIZE])
+        if articles is None:
+            ok = False
+            continue
+        for article in articles.values():
+            on_article(article)
+    log.info("Finish shard from %s to %s", first, last)
+    return ok
+
+
+async def search(on_article):
+    first = datetime.datetime.strptime(start, DATE_FORMAT).date()
+    last = datetime.datetime.strptime(end, DATE_FORMAT).date()
+    shards = await split_range(first, last)
+    log.info("Search %d results in %d shards", sum(shard[2] for shard in shards), len(shards))
+    semaphore = asyncio.Semaphore(SHARDS)
+
+    async def run(shard):
+        async with semaphore:
+            return await search_shard(shard, on_article)
+
+    results = await asyncio.gather(*[run(shard) for shard in shards])
+    return results.count(False)
+
+
+sink = None
+seen = set()
+
+
+def open_output(resume=False):
+    """
+    Open the output for appending, with PMIDs written before if resuming
+    """
+    global sink
+    if os.path.exists(OUTPUT):
+        if not resume:
+            log.error("Output file %s exists!", OUTPUT)
+            log.error("Use arguments --resume to resume from previous work.")
+            quit()
+        for record in store.iter_json_lines(OUTPUT):
+            seen.add(record['pmid'])
+        log.info("Resume with %d articles in %s", len(seen), OUTPUT)
+    sink = store.JsonLinesSink(OUTPUT)
+
+
+def add_article(article):
+    # Shards overlap when the publication date of an article is ambiguous
+    pmid = article['pmid']
+    if pmid in seen:
+        return
+    seen.add(pmid)
+
+    sink.write({
         'pmid': pmid,
-        'title': title,
-        'keywords': keywords,
-        'publication_date': str(publication_date),
-        'abstract': abstract
+        'title': article['title'],
+        'keywords': article['keywords'],
+        'publication_date': article['publication_date'],
+        'abstract': article['abstract']
     })
 
-    save()
 
-save(force=True)
+def parse_arguments():
+    parser = arg.ArgumentParser(description='Search entries from pubmed')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help=f'Resume from an exist {OUTPUT}, without fetching articles in it again')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    open_output(resume=args.resume)
+    try:
+        failed = fetch.run(search(add_article))
+    finally:
+        sink.close()
+    log.info("Fetched %d articles in total", len(seen))
+    store.consolidate(OUTPUT, CONSOLIDATED)
+    if failed:
+        log.warning("%d shards are incomplete, use --resume to fetch the missing results", failed)
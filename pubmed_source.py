@@ -0,0 +1,111 @@
+import os
+import json
+import logging as log
+import pubmed_store as store
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\r\n'
+
+decoder = json.JSONDecoder()
+
+
+def iter_json_array(path):
+    """
+    Iterate elements of a JSON array, parsed incrementally
+
+    Only the element being parsed and a chunk of the file are kept in memory.
+    """
+    with open(path, 'r') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, pos, eof
+            chunk = f.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def next_char(skipped):
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in skipped:
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return buffer[pos:pos + 1]
+                fill()
+
+        if next_char(WHITESPACE) != '[':
+            raise ValueError(f"{path} is not a JSON array")
+        pos += 1
+        while True:
+            char = next_char(WHITESPACE + ',')
+            if char == ']':
+                return
+            if not char:
+                raise ValueError(f"Unexpected end of JSON array in {path}")
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # A number might be cut by the end of the buffer
+                    if eof or (end < len(buffer) and buffer[end] in WHITESPACE + ',]'):
+                        break
+                except ValueError:
+                    if eof:
+                        raise
+                fill()
+            pos = end
+            yield value
+
+
+def iter_text_lines(path):
+    """
+    Iterate non-empty lines of a text file, one ID per line
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def iter_file(path):
+    """
+    Iterate items of a source file, as JSON array, JSON lines or text lines
+
+    The format is told by the first non-blank character of the file.
+    """
+    with open(path, 'r') as f:
+        first = ''
+        while not first:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return iter(())
+            first = chunk.lstrip()[:1]
+    if first == '[':
+        return iter_json_array(path)
+    if first == '{':
+        return store.iter_json_lines(path)
+    return iter_text_lines(path)
+
+
+def iter_pdf_dir(path):
+    """
+    Iterate PDFs named as "PMID.pdf" under path, in a stable order
+    """
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename[-4:].lower() != '.pdf':
+                continue
+            file_path = os.path.join(root, filename)
+            try:
+                pmid = int(filename[:-4])
+            except ValueError:
+                log.warning("Error in loading source dir at file %s", file_path)
+                continue
+            yield {
+                'pmid': pmid,
+                'path': file_path
+            }
@@ -0,0 +1,257 @@
+import os
+import json
+import sqlite3
+import logging as log
+
+FLUSH_EVERY = 100
+
+
+class JsonLinesSink:
+    """
+    Append records to a JSON Lines file, flushed every `flush_every` records
+
+    Records not flushed yet are lost if the process is killed, so the sink
+    must be closed when a run ends or aborts. A file `shared` with other
+    processes is never truncated, as its last line may be still written by
+    another one. A torn last line is ended instead, and skipped when read.
+    """
+
+    def __init__(self, path, flush_every=FLUSH_EVERY, shared=False):
+        self.path = path
+        self.flush_every = flush_every
+        self.pending = 0
+        if not shared:
+            truncate_torn_line(path)
+        self.file = open(path, 'a')
+        if shared and not ends_with_newline(path):
+            self.file.write('\n')
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.pending = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def ends_with_newline(path) -> bool:
+    with open(path, 'rb') as f:
+        if f.seek(0, os.SEEK_END) == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def truncate_torn_line(path):
+    """
+    Drop the last line if torn by a crash, so appended records stay valid
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - 4096)
+            f.seek(start)
+            chunk = f.read(pos - start)
+            newline = chunk.rfind(b'\n')
+            if newline >= 0:
+                pos = start + newline + 1
+                break
+            pos = start
+        if pos < end:
+            log.debug("Truncate torn line at the end of %s", path)
+            f.truncate(pos)
+
+
+def iter_json_lines(path):
+    """
+    Iterate records of a JSON Lines file, skipping torn lines
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                log.debug("Skip invalid line in %s", path)
+
+
+def import_json_array(json_path, jsonl_path):
+    """
+    Convert a JSON array written by old versions into JSON Lines
+    """
+    if os.path.exists(jsonl_path) or not os.path.exists(json_path):
+        return
+    try:
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        with open(jsonl_path, 'w') as f:
+            for record in data:
+                f.write(json.dumps(record) + '\n')
+        log.info("Import %d records from %s", len(data), json_path)
+    except Exception as e:
+        log.warning("Unable to import %s, ignored. %s", json_path, e)
+
+
+def consolidate(jsonl_path, json_path, key=None):
+    """
+    Stream a JSON Lines file into a JSON array, without loading it in memory
+
+    With key, only the last record of each value of the key is kept.
+    """
+    last = None
+    if key is not None:
+        last = {}
+        for idx, record in enumerate(iter_json_lines(jsonl_path)):
+            last[record.get(key)] = idx
+        last = set(last.values())
+    tmp_path = json_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('[')
+        first = True
+        for idx, record in enumerate(iter_json_lines(jsonl_path)):
+            if last is not None and idx not in last:
+                continue
+            if not first:
+                f.write(', ')
+            first = False
+            f.write(json.dumps(record))
+        f.write(']')
+    os.replace(tmp_path, json_path)
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS articles (
+    pmid INTEGER PRIMARY KEY,
+    title TEXT,
+    author TEXT
+);
+CREATE TABLE IF NOT EXISTS abstracts (
+    pmid INTEGER PRIMARY KEY,
+    abstract TEXT
+);
+CREATE TABLE IF NOT EXISTS mesh_terms (
+    pmid INTEGER NOT NULL,
+    term TEXT NOT NULL,
+    major INTEGER NOT NULL,
+    PRIMARY KEY (pmid, term)
+);
+CREATE INDEX IF NOT EXISTS mesh_terms_term ON mesh_terms (term, major);
+CREATE TABLE IF NOT EXISTS figures (
+    pmid INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    caption TEXT,
+    url TEXT,
+    local_path TEXT,
+    PRIMARY KEY (pmid, id)
+);
+CREATE TABLE IF NOT EXISTS sections (
+    pmid INTEGER NOT NULL,
+    sec_idx INTEGER NOT NULL,
+    parent_idx INTEGER,
+    id TEXT,
+    head TEXT,
+    PRIMARY KEY (pmid, sec_idx)
+);
+CREATE INDEX IF NOT EXISTS sections_head ON sections (head);
+CREATE TABLE IF NOT EXISTS paragraphs (
+    pmid INTEGER NOT NULL,
+    sec_idx INTEGER NOT NULL,
+    para_idx INTEGER NOT NULL,
+    id TEXT,
+    content TEXT,
+    figs TEXT,
+    PRIMARY KEY (pmid, sec_idx, para_idx)
+);
+'''
+
+
+class SqliteStore:
+    """
+    Indexed SQLite store of MeSH terms, figures and parsed content
+
+    Writes of an article replace its previous rows. They are grouped into one
+    transaction, committed every `flush_every` articles.
+    """
+
+    def __init__(self, path, flush_every=FLUSH_EVERY):
+        self.path = path
+        self.flush_every = flush_every
+        self.pending = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SQLITE_SCHEMA)
+
+    def write_article(self, pmid, title, abstract):
+        self.conn.execute('INSERT OR IGNORE INTO articles (pmid) VALUES (?)', (pmid,))
+        self.conn.execute('UPDATE articles SET title = ? WHERE pmid = ?', (title, pmid))
+        self.conn.execute('INSERT OR REPLACE INTO abstracts VALUES (?, ?)', (pmid, abstract))
+        self.written()
+
+    def write_mesh(self, pmid, meshes):
+        self.conn.execute('INSERT OR IGNORE INTO articles (pmid) VALUES (?)', (pmid,))
+        self.conn.execute('DELETE FROM mesh_terms WHERE pmid = ?', (pmid,))
+        self.conn.executemany('INSERT OR REPLACE INTO mesh_terms VALUES (?, ?, ?)',
+                              [(pmid, mesh['term'], int(mesh['major'])) for mesh in meshes])
+        self.written()
+
+    def write_figures(self, pmid, figures):
+        self.conn.execute('INSERT OR IGNORE INTO articles (pmid) VALUES (?)', (pmid,))
+        self.conn.execute('DELETE FROM figures WHERE pmid = ?', (pmid,))
+        self.conn.executemany('INSERT OR REPLACE INTO figures VALUES (?, ?, ?, ?, ?, ?)', [
+            (pmid, fig['id'], fig.get('name'), fig.get('caption'),
+             fig.get('url', fig.get('src')), fig.get('local_path', fig.get('filepath')))
+            for fig in figures])
+        self.written()
+
+    def write_content(self, pmid, data):
+        self.conn.execute('INSERT OR REPLACE INTO articles VALUES (?, ?, ?)',
+                          (pmid, data.get('title'), data.get('author')))
+        self.conn.execute('DELETE FROM sections WHERE pmid = ?', (pmid,))
+        self.conn.execute('DELETE FROM paragraphs WHERE pmid = ?', (pmid,))
+        sections = []
+        paragraphs = []
+
+        def add_section(sec, parent_idx=None):
+            sec_idx = len(sections)
+            sections.append((pmid, sec_idx, parent_idx, sec.get('id'), sec.get('head')))
+            for para_idx, para in enumerate(sec.get('paras', [])):
+                paragraphs.append((pmid, sec_idx, para_idx, para.get('id'), para.get('content'),
+                                   json.dumps(para.get('figs', []))))
+            for sub_sec in sec.get('sub_secs', []):
+                add_section(sub_sec, sec_idx)
+
+        for sec in data.get('section', []):
+            add_section(sec)
+        self.conn.executemany('INSERT INTO sections VALUES (?, ?, ?, ?, ?)', sections)
+        self.conn.executemany('INSERT INTO paragraphs VALUES (?, ?, ?, ?, ?, ?)', paragraphs)
+        if 'images' in data:
+            self.write_figures(pmid, data['images'])
+        else:
+            self.written()
+
+    def written(self):
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
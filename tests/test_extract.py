@@ -0,0 +1,52 @@
+import asyncio
+import pytest
+
+pytest.importorskip('pdfminer')
+
+import pubmed_extract as extract
+
+PAGES = 7
+
+
+def make_pdf(pages, count=None) -> bytes:
+    """PDF of pages with a line of text each, count overrides the page tree count"""
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for i in range(pages):
+        content = f'BT /F1 24 Tf 72 700 Td (Page {i + 1} of the fixture) Tj ET'.encode()
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content))
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % len(objects))
+        kids.append(b'%d 0 R' % len(objects))
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(kids), pages if count is None else count)
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (number, obj)
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return pdf
+
+
+def extract_sharded(pdf_path, dest, shard_pages):
+    pool = extract.ExtractPool(2, shard_pages=shard_pages)
+    try:
+        asyncio.run(pool.extract_to(pdf_path, dest))
+    finally:
+        pool.close()
+    return dest.read_text()
+
+
+@pytest.mark.parametrize('count', [PAGES, PAGES - 3])
+def test_sharded_extraction_matches_whole(tmp_path, count):
+    pdf_path = tmp_path / 'fixture.pdf'
+    pdf_path.write_bytes(make_pdf(PAGES, count))
+    whole = tmp_path / 'whole.txt'
+    extract.extract_to(str(pdf_path), str(whole))
+    assert 'Page 1 of' in whole.read_text() and f'Page {PAGES} of' in whole.read_text()
+    assert extract.count_pages(str(pdf_path)) == count
+    assert extract_sharded(str(pdf_path), tmp_path / 'sharded.txt', 2) == whole.read_text()
@@ -0,0 +1,45 @@
+import json
+import asyncio
+from types import SimpleNamespace
+import pubmed_fetch as fetch
+import pubmed_idconv as idconv
+
+
+def serve(monkeypatch, records):
+    """Stand in for the ID converter, answering every request with records"""
+    requested = []
+
+    async def get_html(url, use_proxy=False):
+        requested.append(url)
+        return SimpleNamespace(status_code=200, content=json.dumps({'records': records}).encode())
+
+    monkeypatch.setattr(fetch, 'get_html', get_html)
+    return requested
+
+
+def test_fetch_pmcids(monkeypatch):
+    requested = serve(monkeypatch, [
+        {'pmid': '1', 'pmcid': 'PMC10'},
+        {'requested-id': '2', 'status': 'error', 'errmsg': 'Identifier not found in PMC'},
+        {'requested-id': '3', 'status': 'error', 'errmsg': 'invalid article id'},
+    ])
+    result = asyncio.run(idconv.fetch_pmcids(['1', '2', '3', '4']))
+    assert result == {'1': 'PMC10', '2': None}
+    assert len(requested) == 1
+
+
+def test_resolve_retries_unresolved(monkeypatch, tmp_path):
+    cache_path = str(tmp_path / 'idconv.jsonl')
+    serve(monkeypatch, [{'requested-id': '3', 'status': 'error', 'errmsg': 'invalid article id'}])
+    converter = idconv.IdConverter(cache_path)
+    assert asyncio.run(converter.resolve(['3', '4'])) == {}
+    converter.close()
+
+    requested = serve(monkeypatch, [
+        {'pmid': '3', 'pmcid': 'PMC30'},
+        {'requested-id': '4', 'status': 'error', 'errmsg': 'not found'},
+    ])
+    converter = idconv.IdConverter(cache_path)
+    assert asyncio.run(converter.resolve(['3', '4'])) == {'3': 'PMC30', '4': None}
+    converter.close()
+    assert len(requested) == 1
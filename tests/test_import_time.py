@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+import subprocess
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = ['pubmed_central.py', 'pubmed_info.py', 'pubmed_info.reader.py', 'pubmed_search.py']
+# Seconds to show the help of a script, including the interpreter startup
+BUDGET = 2.0
+# Imported on first use only
+HEAVY_MODULES = ['aiohttp', 'bs4', 'pdfminer', 'lxml']
+
+RUN_HELP = '''
+import sys, runpy
+sys.argv = [sys.argv[1], '--help']
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+print('imported:', *[name for name in {heavy!r} if name in sys.modules], file=sys.stderr)
+'''.format(heavy=HEAVY_MODULES)
+
+
+@pytest.mark.parametrize('script', SCRIPTS)
+def test_help_within_budget(script):
+    started = time.monotonic()
+    result = subprocess.run([sys.executable, '-c', RUN_HELP, os.path.join(ROOT, script)],
+                            cwd=ROOT, capture_output=True, text=True, timeout=30)
+    elapsed = time.monotonic() - started
+    assert result.returncode == 0, result.stderr
+    assert 'usage:' in result.stdout
+    imported = [line for line in result.stderr.splitlines() if line.startswith('imported:')]
+    assert imported == ['imported:'], f"{script} {imported} at startup"
+    assert elapsed < BUDGET, f"{script} --help took {elapsed:.2f}s"
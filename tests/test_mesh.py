@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip('lxml')
+pytest.importorskip('bs4')
+
+import pubmed_eutils as eutils
+import pubmed_info as info
+
+# EFetch record and PubMed page of the same article, trimmed to the MeSH terms
+EFETCH = b'''<?xml version="1.0" ?>
+<PubmedArticleSet>
+<PubmedArticle>
+  <MedlineCitation Status="MEDLINE" Owner="NLM">
+    <PMID Version="1">12345</PMID>
+    <Article><ArticleTitle>Title</ArticleTitle></Article>
+    <MeshHeadingList>
+      <MeshHeading>
+        <DescriptorName UI="D006801" MajorTopicYN="N">Humans</DescriptorName>
+      </MeshHeading>
+      <MeshHeading>
+        <DescriptorName UI="D001943" MajorTopicYN="Y">Breast Neoplasms</DescriptorName>
+      </MeshHeading>
+      <MeshHeading>
+        <DescriptorName UI="D000970" MajorTopicYN="N">Antineoplastic Agents</DescriptorName>
+        <QualifierName UI="Q000009" MajorTopicYN="N">adverse effects</QualifierName>
+        <QualifierName UI="Q000627" MajorTopicYN="Y">therapeutic use</QualifierName>
+      </MeshHeading>
+      <MeshHeading>
+        <DescriptorName UI="D005260" MajorTopicYN="Y">Female</DescriptorName>
+        <QualifierName UI="Q000378" MajorTopicYN="N">metabolism</QualifierName>
+      </MeshHeading>
+    </MeshHeadingList>
+  </MedlineCitation>
+</PubmedArticle>
+</PubmedArticleSet>
+'''
+
+TERMS = ['Humans', 'Breast Neoplasms*', 'Antineoplastic Agents / adverse effects',
+         'Antineoplastic Agents / therapeutic use*', 'Female* / metabolism']
+PAGE = '<html><body><div id="mesh-terms"><ul class="keywords-list">{}</ul></div></body></html>'.format(''.join(
+    f'<li><button class="keyword-actions-dropdown" aria-label="{term}">{term}</button></li>' for term in TERMS))
+
+
+def test_parse_mesh_matches_page():
+    articles = list(eutils.iter_articles(EFETCH))
+    assert len(articles) == 1
+    assert articles[0]['mesh'] == info.download_mesh(info.parse_page(PAGE))